@@ -1,59 +1,596 @@
+import os
+import zlib
+import time
+import fcntl
+import pickle
+import cowpy
+import asyncio
+import hashlib
+import sqlite3
+import functools
+import threading
+import simplejson as json
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = cowpy.getLogger()
+
+DEFAULT_TTL = 900
+DEFAULT_COMPRESS_OVER = 1024
+
+def _default_cache_file(name):
+    '''$XDG_CACHE_HOME/frank/<name> (~/.cache/frank/<name>), for a FranKache given no cache_file'''
+    cache_dir = os.path.join(os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'frank')
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, name)
+
+class CacheCodec(object):
+    '''Serializes one FranKache record to bytes, tag identifies the codec in stored entries'''
+
+    tag = None
+
+    def dumps(self, record):
+        raise NotImplementedError()
+
+    def loads(self, data):
+        raise NotImplementedError()
+
+class JsonCodec(CacheCodec):
+    tag = b'j'
+
+    def dumps(self, record):
+        return json.dumps(record, separators=(',', ':')).encode()
+
+    def loads(self, data):
+        return json.loads(data)
+
+class PickleCodec(CacheCodec):
+    '''Fastest for large nested values, but only for cache files written by trusted processes'''
+    tag = b'p'
+
+    def dumps(self, record):
+        return pickle.dumps(record, protocol=5)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+class MsgpackCodec(CacheCodec):
+    tag = b'm'
+
+    def dumps(self, record):
+        if msgpack is None:
+            raise Exception("msgpack codec requested but msgpack is not installed")
+        return msgpack.packb(record)
+
+    def loads(self, data):
+        if msgpack is None:
+            raise Exception("msgpack entry found but msgpack is not installed")
+        return msgpack.unpackb(data)
+
+CODECS = {
+    'json': JsonCodec(),
+    'pickle': PickleCodec(),
+    'msgpack': MsgpackCodec()
+}
+
+CODECS_BY_TAG = { c.tag: c for c in CODECS.values() }
+
+def encode_entry(record, codec, compress_over=DEFAULT_COMPRESS_OVER):
+    '''codec tag + compression flag + payload, zlib-compressed when the payload is over compress_over bytes'''
+    data = codec.dumps(record)
+    if compress_over is not None and len(data) > compress_over:
+        return codec.tag + b'z' + zlib.compress(data)
+    return codec.tag + b'-' + data
+
+def decode_entry(entry):
+    entry = bytes(entry)
+    data = entry[2:]
+    if entry[1:2] == b'z':
+        data = zlib.decompress(data)
+    return CODECS_BY_TAG[entry[0:1]].loads(data)
+
+class CacheBackend(object):
+    '''Single-key storage of FranKache records ({'time': .., 'content': ..})'''
+
+    def get(self, key):
+        raise NotImplementedError()
+
+    def put(self, key, record):
+        '''Stores record, returns the stored bytes if the backend encodes them'''
+        raise NotImplementedError()
+
+    def put_many(self, records):
+        for key in records:
+            self.put(key, records[key])
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+    def keys(self):
+        raise NotImplementedError()
+
+class SqliteCacheBackend(CacheBackend):
+    '''One row per cache id in a WAL-mode sqlite file, safe across threads and processes'''
+
+    filename = None
+    busy_timeout = 30
+    codec = None
+    compress_over = DEFAULT_COMPRESS_OVER
+    _local = None
+
+    def __init__(self, filename, *args, **kwargs):
+        self.filename = filename
+        if 'busy_timeout' in kwargs:
+            self.busy_timeout = kwargs['busy_timeout']
+        self.codec = CODECS[kwargs['codec'] if 'codec' in kwargs and kwargs['codec'] else 'json']
+        if 'compress_over' in kwargs:
+            self.compress_over = kwargs['compress_over']
+        self._local = threading.local()
+
+    def _conn(self):
+        # -- sqlite connections don't cross threads, so keep one per thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # -- autocommit: every statement is its own atomic transaction
+            conn = sqlite3.connect(self.filename, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute('pragma journal_mode=wal')
+            conn.execute('pragma synchronous=normal')
+            conn.execute('create table if not exists frankache (key text primary key, value blob not null)')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._conn().execute('select value from frankache where key = ?', (key,)).fetchone()
+        if not row:
+            return None
+        # -- entries stored as JSON text predate codecs
+        return json.loads(row[0]) if type(row[0]) == str else decode_entry(row[0])
+
+    def put(self, key, record):
+        entry = encode_entry(record, self.codec, self.compress_over)
+        self._conn().execute('insert or replace into frankache (key, value) values (?, ?)', (key, entry))
+        return entry
+
+    def put_many(self, records):
+        conn = self._conn()
+        conn.execute('begin')
+        try:
+            conn.executemany('insert or replace into frankache (key, value) values (?, ?)', [ (k, encode_entry(records[k], self.codec, self.compress_over)) for k in records ])
+            conn.execute('commit')
+        except:
+            conn.execute('rollback')
+            raise
+
+    def delete(self, key):
+        self._conn().execute('delete from frankache where key = ?', (key,))
+
+    def keys(self):
+        return [ r[0] for r in self._conn().execute('select key from frankache') ]
+
+class JsonFileCacheBackend(CacheBackend):
+    '''The original single pretty-printed JSON document, now locked and atomically replaced'''
+
+    filename = None
+
+    def __init__(self, filename, *args, **kwargs):
+        self.filename = filename
+
+    @contextmanager
+    def _locked(self, exclusive=False):
+        with open(f'{self.filename}.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read(self):
+        if not os.path.exists(self.filename):
+            return {}
+        with open(self.filename, 'r') as f:
+            return json.loads(f.read() or '{}')
+
+    def _write(self, contents):
+        # -- write aside and swap in, so readers never see a partial file
+        tmp_file = f'{self.filename}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(json.dumps(contents, indent=4))
+        os.replace(tmp_file, self.filename)
+
+    def get(self, key):
+        with self._locked():
+            contents = self._read()
+        return contents[key] if key in contents else None
+
+    def put(self, key, record):
+        with self._locked(exclusive=True):
+            contents = self._read()
+            contents[key] = record
+            self._write(contents)
+
+    def delete(self, key):
+        with self._locked(exclusive=True):
+            contents = self._read()
+            if key in contents:
+                del contents[key]
+                self._write(contents)
+
+    def keys(self):
+        with self._locked():
+            return list(self._read().keys())
+
+class MemoryCacheTier(object):
+    '''In-process LRU of FranKache records, bounded by entry count and (optionally) content bytes'''
+
+    max_entries = 1024
+    max_bytes = None
+    # -- sizeof(record) -> bytes for records not already encoded, FranKache measures them as its codec encodes them
+    sizeof = None
+    hits = 0
+    misses = 0
+    evictions = 0
+    expirations = 0
+
+    def __init__(self, *args, **kwargs):
+        for k in ['max_entries', 'max_bytes', 'sizeof']:
+            if k in kwargs:
+                setattr(self, k, kwargs[k])
+        self._records = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _sizeof(self, record):
+        # -- only measured when a byte bound is configured
+        if not self.max_bytes:
+            return 0
+        if 'codec' in record:
+            return len(record['content'])
+        return self.sizeof(record) if self.sizeof else len(json.dumps(record['content']))
+
+    def _drop(self, key):
+        self._records.pop(key, None)
+        self._bytes -= self._sizes.pop(key, 0)
+
+    def get(self, key, now, grace=0):
+        with self._lock:
+            record = self._records.get(key)
+            if record is None:
+                self.misses += 1
+                return None
+            if now - record['time'] >= record['ttl'] + grace:
+                self._drop(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._records.move_to_end(key)
+            self.hits += 1
+            return record
+
+    def put(self, key, record, size=None):
+        '''Caches record, size (bytes) if the caller already has it encoded'''
+        if not self.max_entries:
+            return
+        if not self.max_bytes:
+            size = 0
+        elif size is None:
+            size = self._sizeof(record)
+        with self._lock:
+            self._drop(key)
+            self._records[key] = record
+            self._sizes[key] = size
+            self._bytes += size
+            while len(self._records) > self.max_entries or (self.max_bytes and self._bytes > self.max_bytes and len(self._records) > 1):
+                self._drop(next(iter(self._records)))
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+            self._sizes.clear()
+            self._bytes = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'entries': len(self._records),
+            'bytes': self._bytes
+        }
+
 class FranKache(object):
 
-    __types = None 
+    __types = None
+    bucket_name = None
+    cache_file = None
+    backend = None
+    memory = None
+    ttls = None
+    default_ttl = DEFAULT_TTL
+    codec = None
+    compress_over = DEFAULT_COMPRESS_OVER
 
     def __init__(self, *args, **kwargs):
-        if 'types' not in kwargs:
-            raise Exception("Supply 'types' Enum")
-        self.__types = kwargs['types']    
+        # -- types (an Enum of cache types) drives _get_cache_id/_cache_invalidate, memoize doesn't need it
+        self.__types = kwargs['types'] if 'types' in kwargs else None
+        if 'bucket_name' in kwargs:
+            self.bucket_name = kwargs['bucket_name']
+        if 'cache_file' in kwargs:
+            self.cache_file = kwargs['cache_file']
+        if 'backend' in kwargs:
+            if not isinstance(kwargs['backend'], CacheBackend):
+                raise Exception("Provided backend is not CacheBackend")
+            self.backend = kwargs['backend']
+        # -- per-type freshness, e.g. ttls={CacheType.RemoteStats: 60, CacheType.Archives: 3600}
+        self.ttls = kwargs['ttls'] if 'ttls' in kwargs else {}
+        if 'default_ttl' in kwargs:
+            self.default_ttl = kwargs['default_ttl']
+        # -- entry encoding for the default backend: codec='json'|'pickle'|'msgpack', compress_over=bytes (None to never compress)
+        if 'codec' in kwargs:
+            if kwargs['codec'] not in CODECS:
+                raise Exception(f"codec must be one of {list(CODECS.keys())}")
+            self.codec = kwargs['codec']
+        if 'compress_over' in kwargs:
+            self.compress_over = kwargs['compress_over']
+        self.memory = MemoryCacheTier(sizeof=self._sizeof, **{ k: kwargs[k] for k in ['max_entries', 'max_bytes'] if k in kwargs })
+
+    def _codec(self):
+        # -- backends without a codec of their own hold JSON
+        return getattr(self._backend(), 'codec', None) or CODECS['json']
+
+    def _sizeof(self, record):
+        # -- what the entry takes encoded, as the backend would store it
+        return len(encode_entry(record['content'], self._codec(), self.compress_over))
+
+    def _backend(self):
+        # -- created on first use, since cache_file may be assigned after __init__
+        # -- the sqlite file sits beside, not on top of, any existing JSON cache_file
+        if self.backend is None:
+            cache_file = self.cache_file or _default_cache_file(self.bucket_name or 'frankache')
+            self.backend = SqliteCacheBackend(f'{cache_file}.db', codec=self.codec, compress_over=self.compress_over)
+            self._cache_migrate()
+        return self.backend
+
+    def _cache_migrate(self):
+        '''Moves records from an original whole-file JSON cache_file into the backend, once'''
+        if not self.cache_file or not os.path.exists(self.cache_file) or isinstance(self.backend, JsonFileCacheBackend):
+            return
+        legacy = JsonFileCacheBackend(self.cache_file)
+        with legacy._locked(exclusive=True):
+            # -- another process may have migrated while we waited on the lock
+            if not os.path.exists(self.cache_file):
+                return
+            contents = legacy._read()
+            logger.info(f'migrating {len(contents)} cache records from {self.cache_file}')
+            self.backend.put_many(contents)
+            os.replace(self.cache_file, f'{self.cache_file}.migrated')
 
     @contextmanager
     def cache(self, read_only=True):
-        
-        contents = {}
-        if not os.path.exists(self.cache_file):
-            with open(self.cache_file, 'w') as f:
-                # self.logger.debug(f'saving {contents}')
-                f.write(json.dumps(contents, indent=4))
-                
-        with open(self.cache_file, 'r') as f:
-            raw_contents = f.read()
-            # self.logger.debug(raw_contents)
-            contents = json.loads(raw_contents)
-            yield contents 
+        '''Whole-cache view for callers that edit many entries at once, every other path is single-key'''
+
+        backend = self._backend()
+        contents = { k: backend.get(k) for k in backend.keys() }
+        original_keys = list(contents.keys())
+        yield contents
         if not read_only:
-            with open(self.cache_file, 'w') as f:
-                f.write(json.dumps(contents, indent=4))
+            for k in original_keys:
+                if k not in contents:
+                    backend.delete(k)
+            for k in contents:
+                backend.put(k, contents[k])
+            self.memory.clear()
 
     def _get_cache_id(self, cache_type, target_name=None):
 
         cache_id = f'bucket-${self.bucket_name}'
 
-        if cache_type == CacheType.RemoteStats:
-            cache_id = f'remote-stats_{cache_id}'
-        elif cache_type == CacheType.Archives:
-            cache_id = f'archives_{cache_id}'
-        
+        # -- no type (or no types) is the plain bucket id, never one of the typed ones
+        if cache_type is not None and self.__types is not None:
+            if cache_type == getattr(self.__types, 'RemoteStats', None):
+                cache_id = f'remote-stats_{cache_id}'
+            elif cache_type == getattr(self.__types, 'Archives', None):
+                cache_id = f'archives_{cache_id}'
+
         if target_name:
             cache_id = f'{cache_id}_target-{target_name}'
-        
-        return cache_id 
 
-    def _cache_store(self, cache_id, content):
-        with self.cache(read_only=False) as contents:        
-            # self.logger.debug(f'storing {content}')
-            contents[cache_id] = { 'time': datetime.strftime(datetime.utcnow(), '%c'), 'content': content }            
+        return cache_id
+
+    def _ttl(self, cache_type):
+        return self.ttls[cache_type] if cache_type in self.ttls else self.default_ttl
+
+    def _fresh(self, record, now, grace=0):
+        # -- records written before epoch timestamps carry a '%c' string and no ttl
+        if type(record['time']) == str:
+            record['time'] = datetime.strptime(record['time'], '%c').replace(tzinfo=timezone.utc).timestamp()
+        if 'ttl' not in record:
+            record['ttl'] = self.default_ttl
+        return now - record['time'] < record['ttl'] + grace
+
+    def _record_content(self, record):
+        # -- memoized values sit in the memory tier encoded, each hit decodes its own copy
+        if 'codec' in record:
+            return CODECS_BY_TAG[record['codec']].loads(record['content'])
+        return record['content']
+
+    def _encoded_record(self, record):
+        codec = self._codec()
+        return { **record, 'content': codec.dumps(record['content']), 'codec': codec.tag }
+
+    def _cache_store(self, cache_id, content, cache_type=None, ttl=None):
+        # self.logger.debug(f'storing {content}')
+        record = { 'time': time.time(), 'ttl': ttl if ttl is not None else self._ttl(cache_type), 'content': content }
+        # -- a value the codec can't encode raises here, before either tier holds it
+        entry = self._backend().put(cache_id, record)
+        self.memory.put(cache_id, record, size=len(entry) if entry is not None else None)
+
+    def _cache_lookup(self, cache_id, grace=0, encode=False):
+        '''The record for cache_id if younger than its ttl plus grace, memory first, encode keeps it encoded in memory'''
+        now = time.time()
+        record = self.memory.get(cache_id, now, grace=grace)
+        if record is not None:
+            return record
+        record = self._backend().get(cache_id)
+        if record is None:
+            return None
+        if not self._fresh(record, now, grace=grace):
+            self._backend().delete(cache_id)
+            return None
+        self.memory.put(cache_id, self._encoded_record(record) if encode else record)
+        return record
 
     def _cache_fetch(self, cache_id):
-        content = None 
-        with self.cache() as contents:
-            if cache_id in contents:
-                content_record = contents[cache_id]
-                if (datetime.utcnow() - datetime.strptime(content_record['time'], '%c')).total_seconds() < 900:
-                    content = content_record['content']
-        return content 
+        record = self._cache_lookup(cache_id)
+        return self._record_content(record) if record is not None else None
 
     def _cache_invalidate(self, target_name):
-        with self.cache(read_only=False) as contents:
-            for t in CacheType:
-                del contents[self._get_cache_id(t, target_name)]
\ No newline at end of file
+        # -- missing keys are fine, there is nothing to invalidate
+        for t in self.__types or []:
+            cache_id = self._get_cache_id(t, target_name)
+            self.memory.delete(cache_id)
+            self._backend().delete(cache_id)
+
+    def _cache_prune(self):
+        '''Deletes every expired record from the backend'''
+        now = time.time()
+        backend = self._backend()
+        for cache_id in backend.keys():
+            record = backend.get(cache_id)
+            if record is not None and not self._fresh(record, now):
+                backend.delete(cache_id)
+
+    def stats(self):
+        '''Memory tier hit/miss/eviction counters'''
+        return self.memory.stats()
+
+    def memoize(self, ttl=None, key=None, stale_ttl=0):
+        '''
+        Caches a function's return value, sync or async, keyed on its arguments
+            ttl: seconds a value is fresh (default_ttl if not given)
+            key: callable taking the function's arguments and returning the cache key, needed when arguments don't serialize stably (e.g. self)
+            stale_ttl: seconds past ttl a stale value is still returned while it is recomputed in the background
+        Values are compressed by the backend, per its codec's compress_over.
+        Values go through the backend codec (json turns tuples into lists, pickle keeps them), every call gets its own copy
+        and a value the codec can't encode is returned without being cached.
+        Concurrent misses on the same key share a single call.
+        '''
+
+        def decorator(fn):
+
+            prefix = f'memoize_{fn.__module__}.{fn.__qualname__}'
+            inflight = {}
+            inflight_lock = threading.Lock()
+
+            def cache_id(args, kwargs):
+                if key:
+                    return f'{prefix}_{key(*args, **kwargs)}'
+                return f'{prefix}_{hashlib.sha256(json.dumps([args, kwargs], sort_keys=True, default=repr).encode()).hexdigest()}'
+
+            def stale(record):
+                return time.time() - record['time'] >= record['ttl']
+
+            def store(cid, result):
+                record = { 'time': time.time(), 'ttl': ttl if ttl is not None else self.default_ttl, 'content': result }
+                try:
+                    encoded = self._encoded_record(record)
+                    self._backend().put(cid, record)
+                except Exception:
+                    logger.warning(f'not caching {cid}, the result did not store with the {type(self._codec()).__name__}')
+                    logger.exception()
+                    return result
+                self.memory.put(cid, encoded)
+                # -- the same type, and a copy, as later hits will get
+                return self._record_content(encoded)
+
+            def call(cid, args, kwargs):
+                # -- single-flight: the first caller computes, the rest wait on its result
+                with inflight_lock:
+                    flight = inflight.get(cid)
+                    leader = flight is None
+                    if leader:
+                        flight = inflight[cid] = { 'done': threading.Event(), 'result': None, 'error': None }
+                if not leader:
+                    flight['done'].wait()
+                    if flight['error']:
+                        raise flight['error']
+                    return flight['result']
+                try:
+                    flight['result'] = store(cid, fn(*args, **kwargs))
+                    return flight['result']
+                except Exception as e:
+                    flight['error'] = e
+                    raise
+                finally:
+                    with inflight_lock:
+                        del inflight[cid]
+                    flight['done'].set()
+
+            def revalidate(cid, args, kwargs):
+                try:
+                    call(cid, args, kwargs)
+                except Exception:
+                    logger.error(f'revalidating {cid} failed')
+                    logger.exception()
+
+            def revalidated(task):
+                if not task.cancelled() and task.exception():
+                    logger.error(f'revalidating failed: {task.exception()}')
+
+            async def call_async(cid, args, kwargs):
+                # -- tasks belong to a loop, so flights are per loop
+                flight_id = (id(asyncio.get_running_loop()), cid)
+                with inflight_lock:
+                    task = inflight.get(flight_id)
+                    if task is None:
+                        async def fill():
+                            return store(cid, await fn(*args, **kwargs))
+                        task = inflight[flight_id] = asyncio.ensure_future(fill())
+                        task.add_done_callback(lambda t: inflight.pop(flight_id, None))
+                return await asyncio.shield(task)
+
+            if asyncio.iscoroutinefunction(fn):
+
+                @functools.wraps(fn)
+                async def wrapper(*args, **kwargs):
+                    cid = cache_id(args, kwargs)
+                    record = self._cache_lookup(cid, grace=stale_ttl, encode=True)
+                    if record is None:
+                        return await call_async(cid, args, kwargs)
+                    if stale(record):
+                        asyncio.ensure_future(call_async(cid, args, kwargs)).add_done_callback(revalidated)
+                    return self._record_content(record)
+
+            else:
+
+                @functools.wraps(fn)
+                def wrapper(*args, **kwargs):
+                    cid = cache_id(args, kwargs)
+                    record = self._cache_lookup(cid, grace=stale_ttl, encode=True)
+                    if record is None:
+                        return call(cid, args, kwargs)
+                    if stale(record) and cid not in inflight:
+                        threading.Thread(target=revalidate, args=(cid, args, kwargs), daemon=True).start()
+                    return self._record_content(record)
+
+            def invalidate(*args, **kwargs):
+                cid = cache_id(args, kwargs)
+                self.memory.delete(cid)
+                self._backend().delete(cid)
+
+            wrapper.invalidate = invalidate
+            return wrapper
+
+        return decorator
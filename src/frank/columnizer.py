@@ -1,5 +1,11 @@
+import io
+import csv
+import sys
+import numbers
+import itertools
 import cowpy
 import subprocess
+import simplejson as json
 
 FOREGROUND_COLOR_PREFIX = '\033[38;2;'
 FOREGROUND_COLOR_SUFFIX = 'm'
@@ -15,6 +21,9 @@ COLOR_TABLE = {
     'yellow': '165:165:0'
 }
 
+FORMATS = ['text', 'tsv', 'csv', 'jsonl']
+DELIMITERS = { 'tsv': '\t', 'csv': ',' }
+
 def colorwrapper(text, color):
     return f'{FOREGROUND_COLOR_PREFIX}{COLOR_TABLE[color]}{FOREGROUND_COLOR_SUFFIX}{text}{FOREGROUND_COLOR_RESET}'
 
@@ -33,6 +42,19 @@ class Columnizer(object):
     row_color_default = 'orange'
     quiet = False 
     headers = True 
+    # -- any file-like, sys.stdout when not given
+    output = None 
+    # -- the original tabs/printf rendering through a shell, one per 500 rows
+    shell = False 
+    write_chunk_rows = 1000
+    # -- text (aligned), tsv, csv or jsonl, the machine formats are never padded or colored
+    format = 'text'
+    # -- None colors text output only when it goes to a terminal
+    color = None 
+    # -- infer each column's alignment from this many rows, when alignment is not given 
+    alignment_sample = 100
+    # -- size column widths from this many evenly spaced rows (always the same ones) instead of all of them 
+    width_sample = None 
 
     def __init__(self, *args, **kwargs):
         
@@ -49,62 +71,142 @@ class Columnizer(object):
         if not self.logger:            
             self.logger = cowpy.getLogger()
 
-    def _pad_tabs(self, data):
+    def _stringify(self, data):
+        '''Rows -> columns of strings, short rows filled out with empty cells'''
+        # -- a column at a time, str() mapped over each is the cheapest way to touch every cell once
+        return [ list(map(str, col)) for col in itertools.zip_longest(*data, fillvalue='') ]
+
+    def _pad_tabs(self, columns):
+        '''Widens the tab stops to fit the widest (already stringified) cell of each column'''
 
         # -- initialize tabs array 
-        if not self.tabs and len(data) > 0:
-            self.tabs = [ 1 for c in data[0] ]
+        if not self.tabs and len(columns) > 0:
+            self.tabs = [ 1 for c in columns ]
             self.tabs.append(1)
         
         self.logger.debug(self.tabs)
 
-        for rix, row in enumerate(data):
-            # -- we're calculating the space from the start of each cell to the start of the next
-            # -- don't bother looking at the last element 
-            for cix, col in enumerate(data[rix]):
-                curr_tab = self.tabs[cix+1] - self.tabs[cix]
-                cell_value = str(data[rix][cix])
-                cell_width = len(cell_value) + self.cell_padding
-                extra = cell_width - curr_tab
-                
-                # if cix < len(self.tabs):
-                #     self.tabs[cix] = self.tabs[cix] + extra 
+        if len(columns) == 0:
+            return 
+
+        # -- estimate from a sample, cells wider than the sampled width push their row out of line
+        if self.width_sample and len(columns[0]) > self.width_sample:
+            step = -(-len(columns[0]) // self.width_sample)
+            columns = [ col[::step] for col in columns ]
 
-                self.tabs = [ m + extra if (i >= cix+1 and extra > 0) else m for i,m in enumerate(self.tabs) ]
+        # -- the space from the start of each cell to the start of the next, column by column
+        widths = [ max(map(len, col)) + self.cell_padding for col in columns ]
 
-                # self.logger.debug(f'{cell_value} (p {self.cell_padding}) -> {",".join([ str(t) for t in self.tabs ])}')
-                # self.logger.debug(f'curr_tab: {curr_tab}, cell_value: {cell_value}, cell_width: {cell_width}, extra: {extra}, cix_tabs: {self.tabs[cix]}')
+        tabs = [ self.tabs[0] ]
+        for cix, width in enumerate(widths):
+            curr_tab = self.tabs[cix+1] - self.tabs[cix] if cix + 1 < len(self.tabs) else 0
+            tabs.append(tabs[-1] + (width if width > curr_tab else curr_tab))
+        self.tabs = tabs
 
     def _align_spaces(self, value, cell_width, alignment):
         '''Calculate cell whitespace and place it to the left or right of cell value to align it to the right or left of the cell'''
         # self.logger.debug(f'{value} {cell_width} {alignment}')
         if alignment == 'r':
-            return f'{"".join([ " " for i in range(cell_width - self.cell_padding - len(value)) ])}{value}'
+            return value.rjust(cell_width - self.cell_padding)
         return value
 
     def _align_on_type(self, value):
+        if isinstance(value, bool) or value is None:
+            return 'l'
+        if isinstance(value, numbers.Number):
+            return 'r'
+        if not isinstance(value, str) or not value or not (value[0].isdigit() or value[0] in '+-.'):
+            return 'l'
         try:
             tried = float(value)
             return 'r'
-        except:
+        except ValueError:
             return 'l'
 
-    def _align_table(self, data):
-        return [ 
-            [ 
-                self._align_spaces(
-                    str(r), 
-                    cell_width=self.tabs[i+1] - self.tabs[i], 
-                    alignment=self.alignment[i] if self.alignment else self._align_on_type(r)
-                ) if i < len(row) 
-                else str(r) 
-                for i,r in enumerate(row) 
-            ] for row in data 
-        ]
+    def _infer_alignment(self, data):
+        '''Per column, right when every non-null value in the first alignment_sample raw rows is a number, left otherwise'''
+        sample = itertools.islice(data, self.alignment_sample)
+        alignment = []
+        for col in itertools.zip_longest(*sample, fillvalue=None):
+            kinds = { self._align_on_type(v) for v in col if v is not None }
+            alignment.append('r' if kinds == {'r'} else 'l')
+        return alignment
+
+    def _align_table(self, data, alignment):
+        '''Right-justifies the right-aligned columns of stringified rows, in place, for the shell path'''
+        right = [ (i, self.tabs[i+1] - self.tabs[i] - self.cell_padding) for i, a in enumerate(alignment) if a == 'r' and i + 1 < len(self.tabs) ]
+        if right:
+            for row in data:
+                for i, width in right:
+                    if i < len(row):
+                        row[i] = row[i].rjust(width)
+        return data
 
     # def _table_data(self, table):
     #     return "\n".join([ "\t".join([ str(v) for v in v in row ]) for row in table ])
 
+    def _row_format(self, columns, alignment):
+        '''One str.format template for a whole row, so the padding and alignment of every cell happen in a single call'''
+        last = len(columns) - 1
+        cells = []
+        for c in range(len(columns)):
+            width = self.tabs[c+1] - self.tabs[c] if c + 1 < len(self.tabs) else 0
+            # -- like printf's tabs, every cell but the last runs out to the next stop
+            if width and c < len(alignment) and alignment[c] == 'r':
+                cells.append(f'{{:>{width - self.cell_padding}}}' + (' ' * self.cell_padding if c < last else ''))
+            else:
+                cells.append(f'{{:<{width}}}' if width and c < last else '{}')
+        return "".join(cells)
+
+    def _render_lines(self, columns, alignment, color, highlight_template=None):
+        '''Each row of the string columns padded out to the tab stops, aligned and wrapped in its color'''
+        lines = list(itertools.starmap(self._row_format(columns, alignment).format, zip(*columns)))
+        if self._colors():
+            lines = [ colorwrapper(line, color if not (highlight_template and highlight_template[i]) else highlight_template[i].value) for i, line in enumerate(lines) ]
+        return lines
+
+    def _colors(self):
+        if self.color is not None:
+            return self.color 
+        output = self.output or sys.stdout
+        return hasattr(output, 'isatty') and output.isatty()
+
+    def _machine_text(self, rows, header=None):
+        '''Raw (not stringified) rows as one block of tsv, csv or jsonl'''
+        if self.format in DELIMITERS:
+            # -- None is an empty cell (null in jsonl), cells holding the delimiter, a quote or a newline are quoted
+            buffer = io.StringIO()
+            csv.writer(buffer, delimiter=DELIMITERS[self.format], quoting=csv.QUOTE_MINIMAL, lineterminator="\n").writerows(rows)
+            return buffer.getvalue()
+        if header:
+            return "".join([ json.dumps(dict(zip(header, row)), default=str) + "\n" for row in rows ])
+        return "".join([ json.dumps(list(row), default=str) + "\n" for row in rows ])
+
+    def _write_machine(self, rows, header=None):
+        '''Writes raw rows in the machine format, a chunk of write_chunk_rows per write'''
+        output = self.output or sys.stdout
+        rows = iter(rows)
+        if header and self.headers and self.format != 'jsonl':
+            output.write(self._machine_text([header]))
+        while True:
+            chunk = list(itertools.islice(rows, self.write_chunk_rows))
+            if not chunk:
+                break 
+            output.write(self._machine_text(chunk, header=header if self.headers else None))
+        output.flush()
+
+    def _write(self, lines):
+        output = self.output or sys.stdout
+        for cursor in range(0, len(lines), self.write_chunk_rows):
+            output.write("\n".join(lines[cursor:cursor + self.write_chunk_rows]) + "\n")
+        output.flush()
+
+    def _set_widths(self, widths):
+        '''Fixes the tab stops from declared content widths, one per column'''
+        self.tabs = [1]
+        for width in widths:
+            self.tabs.append(self.tabs[-1] + width + self.cell_padding)
+
     def _printf_command(self, data, color, highlight_template=None):
         tabs_cmd = f'tabs {",".join([ str(c) for c in self.tabs ])}'
         print_data = "\n\"; \n printf \"".join([ colorwrapper("\t".join([ str(v) for v in row ]), color if not (highlight_template and highlight_template[i]) else highlight_template[i].value) for i, row in enumerate(data) ])
@@ -122,9 +224,23 @@ class Columnizer(object):
 
         if not data and self.quiet:
             return 
+
+        if self.format not in FORMATS:
+            raise Exception(f'Columnizer format must be one of {FORMATS}, got {self.format}')
+
+        if self.format != 'text':
+            self._write_machine(table, header)
+            return 
             
+        # -- alignment is settled per column from the raw values before they become strings
+        alignment = self.alignment or self._infer_alignment(table)
+        header_alignment = self.alignment or [ self._align_on_type(h) for h in header or [] ]
+
+        # -- every cell is stringified once, here, and the strings are reused for widths, alignment and output
         if header and self.headers:
-            self._pad_tabs([header])
+            header = self._stringify([header])
+            self._pad_tabs(header)
+        table = self._stringify(table)
         self._pad_tabs(table)
         
         # self.logger.info(self._table_data(header), tabs=self.tabs, color=self.header_color)
@@ -132,21 +248,26 @@ class Columnizer(object):
         
         self.logger.debug(self.tabs)
         
+        if not self.shell:
+            lines = self._render_lines(header, header_alignment, self.header_color) if header and self.headers else []
+            lines.extend(self._render_lines(table, alignment, self.row_color, highlight_template=highlight_template))
+            self._write(lines)
+            return 
+
+        # -- the shell path prints rows
+        if header and self.headers:
+            header = self._align_table([ list(row) for row in zip(*header) ], header_alignment)
+        table = self._align_table([ list(row) for row in zip(*table) ], alignment)
+
         printout_header = ""
         if header and self.headers:
-            header = [header]
-            header = self._align_table(header)
             printout_header = self._printf_command(header, self.header_color)
             
             subprocess.run(printout_header, shell=True)
 
-        table = self._align_table(table)
-
         cursor = 0
         done = False 
 
-        self.logger.debug(f'columnizer printing table: {table}')
-
         while True:
 
             max = cursor + 500
@@ -165,3 +286,51 @@ class Columnizer(object):
                 break 
 
             cursor += 500
+
+    def stream(self, rows, header=None, width_sample=100, widths=None, data=False, **kwargs):
+        '''
+        Prints rows from any iterable as they arrive, holding at most write_chunk_rows of them at a time.
+        Column widths are fixed up front, from declared widths or from the first width_sample rows, 
+        and later cells wider than their column push their row out of line.
+        '''
+
+        for k in kwargs:
+            self.__setattr__(k, kwargs[k])
+
+        if not data and self.quiet:
+            return 
+
+        if self.format not in FORMATS:
+            raise Exception(f'Columnizer format must be one of {FORMATS}, got {self.format}')
+
+        if self.format != 'text':
+            self._write_machine(rows, header)
+            return 
+
+        rows = iter(rows)
+        sample = list(itertools.islice(rows, width_sample))
+        alignment = self.alignment or self._infer_alignment(sample)
+        header_alignment = self.alignment or [ self._align_on_type(h) for h in header or [] ]
+        sample = self._stringify(sample)
+
+        if header and self.headers:
+            header = self._stringify([header])
+
+        if widths:
+            self._set_widths(widths)
+        else:
+            if header and self.headers:
+                self._pad_tabs(header)
+            self._pad_tabs(sample)
+
+        self.logger.debug(self.tabs)
+
+        lines = self._render_lines(header, header_alignment, self.header_color) if header and self.headers else []
+        lines.extend(self._render_lines(sample, alignment, self.row_color))
+        self._write(lines)
+
+        while True:
+            chunk = self._stringify(itertools.islice(rows, self.write_chunk_rows))
+            if not chunk:
+                break 
+            self._write(self._render_lines(chunk, alignment, self.row_color))
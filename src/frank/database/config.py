@@ -12,7 +12,14 @@ ENV_MAPPING = {
     'DB_DATABASE': 'name',
     'DB_PASSWORD': 'password',
     'DB_TYPE': 'dbType',
-    'DB_FILENAME': 'filename'
+    'DB_FILENAME': 'filename',
+    'DB_SQLITE_JOURNAL_MODE': 'journal_mode',
+    'DB_SQLITE_SYNCHRONOUS': 'synchronous',
+    'DB_SQLITE_MMAP_SIZE': 'mmap_size',
+    'DB_SQLITE_CACHE_SIZE': 'cache_size',
+    'DB_SQLITE_TEMP_STORE': 'temp_store',
+    'DB_SQLITE_BUSY_TIMEOUT': 'busy_timeout',
+    'DB_LOCAL_INFILE': 'local_infile'
 }
 
 class DatabaseConfig():
@@ -24,6 +31,19 @@ class DatabaseConfig():
 
     filename = None 
 
+    # -- sqlite pragmas, WAL lets readers and the writer work side by side and only checkpoints fsync
+    journal_mode = 'wal'
+    synchronous = 'normal'
+    mmap_size = 268435456
+    # -- negative is KiB
+    cache_size = -65536
+    temp_store = 'memory'
+    # -- ms
+    busy_timeout = 5000
+
+    # -- mariadb: allow LOAD DATA LOCAL INFILE, the bulk load fast path
+    local_infile = False
+
     dbType = None 
 
     def __init__(self, *args, **kwargs):
@@ -45,6 +65,9 @@ class DatabaseConfig():
                 self.dbType = d 
                 break 
         
+        # -- env values are strings
+        self.local_infile = str(self.local_infile).lower() in ['1', 'true', 'yes', 'on']
+
         if self.dbType not in DbType:
             raise Exception(f'DatabaseConfig dbType {self.dbType} is not of DbType')
         
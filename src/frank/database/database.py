@@ -1,15 +1,27 @@
 import os
+import re
+import csv
+import gzip
 import sys 
+import time
+import zlib
+import itertools
+import threading
+import tempfile
 import traceback 
 import cowpy 
+import simplejson as json
 from enum import Enum
+from collections import OrderedDict
 from contextlib import contextmanager
-from datetime import datetime 
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, UTC
 from mariadb import ProgrammingError 
 
 from frank.database.meta import BaseMeta, InstanceMeta
 from frank.database.config import DatabaseConfig, DbType
-from frank.database.dialect import Dialect, db_dialect_mappings, get_db_connection, TYPE_MAPPINGS
+from frank.database.dialect import Dialect, db_dialect_mappings, get_db_connection, release_db_connection, text, TYPE_MAPPINGS
+from frank.database.expression import Expression
 
 logger = cowpy.getLogger()
 
@@ -33,13 +45,24 @@ class Database(object):
     models = None 
     insert_cols = None 
     last_response = None 
+    # -- read-only copies of the primary, reads are spread across the healthy ones
+    replicas = None
+    # -- seconds after a write during which the writing thread reads from the primary
+    read_your_writes = 2
+    # -- seconds a replica that failed a health check sits out
+    replica_retry = 30
+    # -- name: Database, each holding whole models (Meta.shard) or a slice of their rows (Meta.shard_key)
+    shards = None
+    # -- bounds on the _select result cache used by models with Meta.cache_ttl
+    result_cache_entries = 1024
+    result_cache_rows = 100000
 
     __instance = None 
 
     @staticmethod
-    def createInstance(config: DatabaseConfig):
+    def createInstance(config: DatabaseConfig, replicas: list = None, shards: dict = None):
         '''Triggers the creation of the Database singleton. **Uses environment variables but accepts kwargs to override'''
-        Database(config)
+        Database(config=config, replicas=replicas, shards=shards)
 
     @staticmethod
     def getInstance():
@@ -51,7 +74,10 @@ class Database(object):
     
     def __init__(self, *args, **kwargs):
 
-        if Database.__instance is not None:
+        # -- standalone: a Database outside the singleton, e.g. a shard
+        standalone = 'standalone' in kwargs and kwargs['standalone']
+
+        if Database.__instance is not None and not standalone:
             return 
 
         # required_keys = ['config'] # , 'models']
@@ -66,6 +92,30 @@ class Database(object):
         else:
             self.cfg = DatabaseConfig()
 
+        self.replicas = kwargs['replicas'] if 'replicas' in kwargs and kwargs['replicas'] else []
+        if not all([ isinstance(r, DatabaseConfig) for r in self.replicas ]):
+            raise Exception("Provided replica config is not DatabaseConfig")
+
+        # -- per thread: the open transaction connection and the time of the last write
+        self._local = threading.local()
+        self._replica_turn = itertools.count()
+        self._replica_down = {}
+
+        # -- (table, query, params): (table version, expiry, records), least recently used first
+        # -- writes bump the table version, so entries read before a write are never served after it
+        # -- writes from other processes or through raw() are only caught by the ttl
+        self._result_cache = OrderedDict()
+        self._result_cache_rows = 0
+        self._result_cache_lock = threading.Lock()
+        self._result_cache_stats = { 'hits': 0, 'misses': 0, 'evictions': 0 }
+        self._table_versions = {}
+        # -- bumped for writes to tables we can't name (raw statements), it outdates every entry
+        self._result_cache_epoch = 0
+
+        # -- the order of the shards is the hash order, keep it stable
+        self.shards = { name: Database(config=shard_config, standalone=True) for name, shard_config in (kwargs['shards'] if 'shards' in kwargs and kwargs['shards'] else {}).items() }
+        self._scatter_pool = ThreadPoolExecutor(max_workers=len(self.shards)) if self.shards else None
+
         # self.models = kwargs['models'] if 'models' in kwargs else []
 
         # print(f'models: {self.models}')
@@ -110,20 +160,90 @@ class Database(object):
         #     logger.debug(f'registering {model.__name__}')
         #     model.register_db(self)
 
-        Database.__instance = self 
+        if not standalone:
+            Database.__instance = self
 
     def __repr__(self):
         return str(self.__dict__)
 
-    def dump(self):
-        '''Writes out all database records to stdout'''
-        dump = {}        
-        for model in self.models:
-            dump[model._meta.table] = self._select(model._meta.table)
-        # for table in self.table_names:
-        #     dump[table] = self._select(table, [ c['name'] for c in self.tables['models'][table] ])
-        logger.debug({ t: [ r for r in dump[t]['data'] ] for t in dump })
-        return dump
+    def shard_for(self, value):
+        '''The shard owning rows with this shard key value, by a stable hash of the value'''
+        names = list(self.shards.keys())
+        value = value.name if isinstance(value, Enum) else value
+        return self.shards[names[zlib.crc32(str(value).encode()) % len(names)]]
+
+    def route(self, table_meta, values=None):
+        '''The databases holding the table's rows, narrowed to one shard when the values include the shard key'''
+        if not self.shards or not (table_meta.shard or table_meta.shard_key):
+            return [ self ]
+        if table_meta.shard:
+            if table_meta.shard not in self.shards:
+                raise Exception(f'{table_meta.table} is placed on shard {table_meta.shard}, which is not configured')
+            return [ self.shards[table_meta.shard] ]
+        if values and values.get(table_meta.shard_key) is not None:
+            return [ self.shard_for(values[table_meta.shard_key]) ]
+        # -- every shard numbers its own rows, an id alone matches a different row on each
+        if values and any([ k == 'id' or k.startswith('id__') for k in values ]):
+            raise Exception(f'{table_meta.table} ids are only unique within a shard, give {table_meta.shard_key} along with id')
+        return list(self.shards.values())
+
+    def scatter(self, databases, fn):
+        '''Calls fn(database) on each database, in parallel when there are several, and returns the results in order'''
+        if len(databases) == 1:
+            return [ fn(databases[0]) ]
+        return list(self._scatter_pool.map(fn, databases))
+
+    DUMP_FORMATS = ['ndjson', 'csv']
+
+    def _dump_table(self, model, path, format, compress, chunk_size):
+        '''Streams one table to a file in id order, chunk_size rows per read, written aside and swapped in when complete'''
+
+        id_col = model._meta.identity_col['name']
+        cols = model._meta.select_col_names
+        query = f'select {",".join(cols)} from {model._meta.table} where {id_col} > ? order by {id_col} limit {int(chunk_size)}'
+
+        started = time.monotonic()
+        rows = 0
+        tmp_path = f'{path}.tmp'
+        with (gzip.open(tmp_path, 'wt', newline='') if compress else open(tmp_path, 'w', newline='', buffering=1 << 20)) as f:
+            writer = csv.writer(f) if format == 'csv' else None
+            if writer:
+                writer.writerow(cols)
+            last_id = 0
+            while True:
+                records = self._read(query, (last_id,), dicts=True)
+                if not records:
+                    break
+                if writer:
+                    writer.writerows([ [ r[c] for c in cols ] for r in records ])
+                else:
+                    f.write("".join([ json.dumps(r, default=str) + "\n" for r in records ]))
+                rows += len(records)
+                last_id = records[-1][id_col]
+        os.replace(tmp_path, path)
+
+        elapsed = time.monotonic() - started
+        logger.info(f'Dumped {rows} {model._meta.table} rows to {path} in {elapsed:.1f}s ({rows / elapsed if elapsed else rows:.0f} rows/s)')
+        return rows
+
+    def dump(self, directory='.', format='ndjson', compress=False, parallel=1, chunk_size=10000, models=None):
+        '''Writes every table of the registered models (or the given ones) to its own file in directory, returns rows written per file'''
+
+        if format not in self.DUMP_FORMATS:
+            raise Exception(f'dump format must be one of {self.DUMP_FORMATS}, got {format}')
+
+        # -- a sharded table is dumped from each of its shards, to a file per shard
+        shard_names = { id(db): name for name, db in (self.shards or {}).items() }
+        targets = []
+        for model in models or self.models or []:
+            for db in self.route(model._meta):
+                shard = f'.{shard_names[id(db)]}' if id(db) in shard_names else ''
+                path = os.path.join(directory, f'{model._meta.table}{shard}.{format}{".gz" if compress else ""}')
+                targets.append((db, model, path))
+
+        with ThreadPoolExecutor(max_workers=max(1, parallel)) as pool:
+            counts = list(pool.map(lambda t: t[0]._dump_table(t[1], t[2], format, compress, chunk_size), targets))
+        return { path: count for (_, _, path), count in zip(targets, counts) }
     
     def parse_type(self, column_name, value):
         if value is not None:
@@ -134,11 +254,17 @@ class Database(object):
                         "%Y-%m-%d %H:%M:%S.%f",
                         "%Y-%m-%d %H:%M:%S"
                     ]
+                    try:
+                        # -- covers both formats, and is much cheaper than strptime
+                        return datetime.fromisoformat(value)
+                    except (TypeError, ValueError):
+                        pass
                     for af in attempt_formats:
                         try:
-                            parsed = datetime.strptime(value, af)
+                            return datetime.strptime(value, af)
                         except:
-                            logger.warning(f'failed to parse {value} as {af}')
+                            pass
+                    logger.warning(f'failed to parse {value} as any of {attempt_formats}')
                 return parsed
             elif column_name[0:3] == 'is_':
                 return bool(value)
@@ -164,71 +290,350 @@ class Database(object):
             {db_dialect_mappings[self.cfg.dbType][Dialect.INTEGER]} PRIMARY KEY \
             {db_dialect_mappings[self.cfg.dbType][Dialect.AUTO_INCREMENT]}, \
             {", ".join([ self._column_def(col) for col in table_meta.user_cols ])}, \
-            {", ".join([ self._column_def(col) for col in table_meta.built_in_cols ])})'
+            {", ".join([ self._column_def(col) for col in table_meta.built_in_cols ])}{"".join([ f", {col_def}" for col_def in self._json_generated_column_defs(table_meta) ])})'
     
     @contextmanager
-    def get_cursor(self):
+    def get_cursor(self, conn=None, config=None):
         '''Generic cursor manifestation, dialect fallback, nothing else'''
+        conn = conn or self.conn 
         try:
             # -- some cursors will have their own context 
             # -- e.g. mariadb
-            with self.conn.cursor() as c:
+            with conn.cursor() as c:
                 yield c 
         except TypeError as te:
 
-            yield self.conn.cursor() 
+            yield conn.cursor() 
             
         except AttributeError as ae:
             # -- there is a particular case where self.conn.cursor() will fail with sqlite 
             # -- and simply yieldling self.conn.cursor() is the answer 
             # -- no context will manage the transaction or connection for us
             # try:
-            yield self.conn.cursor()
+            yield conn.cursor()
                 #self.conn.commit()
             # finally:
                 
         except:          
             # -- but if anything else goes wrong, kick
             logger.exception()  
-            # raise
+            # -- and let the caller know, a replica read has to fail to be retried on the primary
+            raise
         finally:
-            self.conn.commit()
-            self.conn.close()
+            conn.commit()
+            release_db_connection(config or self.cfg, conn)
 
     @contextmanager 
-    def cursor(self):
+    def cursor(self, config=None):
+        '''Cursor on the primary, or on the given replica config, or on the open transaction'''
 
-        self.conn = get_db_connection(self.cfg)        
-        self.conn.row_factory = self.dict_factory
-        
-        with self.get_cursor() as c:
+        transaction = getattr(self._local, 'transaction', None)
+        if transaction and config is None:
+            yield transaction.cursor()
+            return
+
+        # -- a connection per cursor context, so concurrent callers don't close each other's connection 
+        conn = get_db_connection(config or self.cfg)
+        conn.row_factory = self.dict_factory
+
+        with self.get_cursor(conn, config=config) as c:
             yield c 
+
+    @contextmanager 
+    def transaction(self):
+        '''Runs every statement in the block, reads included, on one primary connection, committed at the end or rolled back on error'''
+
+        if getattr(self._local, 'transaction', None):
+            yield
+            return
+
+        conn = get_db_connection(self.cfg)        
+        conn.row_factory = self.dict_factory
+        self._local.transaction = conn
+        self._local.transaction_tables = set()
+        try:
+            yield
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        finally:
+            self._local.transaction = None
+            # -- other threads may have cached the tables as they were before the commit (or rollback)
+            for table in self._local.transaction_tables:
+                self._table_changed(table)
+            self._local.last_write = time.monotonic()
+            release_db_connection(self.cfg, conn)
+
+    def _replica_healthy(self, replica):
+        try:
+            conn = get_db_connection(replica)
+            try:
+                conn.cursor().execute('select 1')
+            finally:
+                release_db_connection(replica, conn)
+            return True
+        except:
+            return False
+
+    def check_replicas(self):
+        '''Health checks every replica now, returns the indexes of the healthy ones'''
+        healthy = []
+        for ix, replica in enumerate(self.replicas):
+            if self._replica_healthy(replica):
+                self._replica_down.pop(ix, None)
+                healthy.append(ix)
+            else:
+                self._replica_down[ix] = time.monotonic() + self.replica_retry
+        return healthy
+
+    def _read_targets(self):
+        '''Replica configs to try for a read, round robin over the healthy ones, always ending with the primary (None)'''
+        in_transaction = getattr(self._local, 'transaction', None) is not None
+        recent_write = time.monotonic() - getattr(self._local, 'last_write', float('-inf')) < self.read_your_writes
+        if self.replicas and not in_transaction and not recent_write:
+            now = time.monotonic()
+            start = next(self._replica_turn)
+            for i in range(len(self.replicas)):
+                ix = (start + i) % len(self.replicas)
+                if self._replica_down.get(ix, 0) <= now:
+                    yield ix, self.replicas[ix]
+        yield None, None
+
+    def _table_changed(self, table=None):
+        '''Outdates cached results for the table, or for every table when None, after a write'''
+        # -- only writes send this thread's reads to the primary for a while (read-your-writes), metadata reads don't
+        self._local.last_write = time.monotonic()
+        with self._result_cache_lock:
+            if table is None:
+                self._result_cache_epoch += 1
+            else:
+                self._table_versions[table] = self._table_versions.get(table, 0) + 1
+        if getattr(self._local, 'transaction', None):
+            self._local.transaction_tables.add(table)
+
+    def _table_version(self, table):
+        return (self._result_cache_epoch, self._table_versions.get(table, 0))
+
+    def _cached_read(self, table, query, params, ttl):
+        '''_read through the result cache, records are copied in and out so callers can't change the cached ones'''
+
+        key = (table, query, params)
+        now = time.monotonic()
+        with self._result_cache_lock:
+            version = self._table_version(table)
+            entry = self._result_cache.get(key)
+            if entry and entry[0] == version and entry[1] > now:
+                self._result_cache.move_to_end(key)
+                self._result_cache_stats['hits'] += 1
+                return [ dict(r) for r in entry[2] ]
+            self._result_cache_stats['misses'] += 1
+
+        records = self._read(query, params, dicts=True)
+
+        with self._result_cache_lock:
+            # -- a write landed while we were reading, what we have may predate it
+            if self._table_version(table) != version:
+                return records
+            previous = self._result_cache.pop(key, None)
+            if previous:
+                self._result_cache_rows -= len(previous[2])
+            self._result_cache[key] = (version, now + ttl, [ dict(r) for r in records ])
+            self._result_cache_rows += len(records)
+            while self._result_cache and (len(self._result_cache) > self.result_cache_entries or self._result_cache_rows > self.result_cache_rows):
+                _, evicted = self._result_cache.popitem(last=False)
+                self._result_cache_rows -= len(evicted[2])
+                self._result_cache_stats['evictions'] += 1
+        return records
+
+    def result_cache_stats(self):
+        with self._result_cache_lock:
+            return { **self._result_cache_stats, 'entries': len(self._result_cache), 'rows': self._result_cache_rows }
+
+    def _read(self, query, params=(), dicts=False):
+        '''Runs a read on a replica when one is usable, falling back to the primary'''
+        for ix, replica in self._read_targets():
+            try:
+                with self.cursor(config=replica) as cur:
+                    cur.execute(query, params)
+                    records = cur.fetchall()
+                    if dicts and (replica or self.cfg).dbType == DbType.MariaDB:
+                        records = [ self.dict_factory(cur, row=r) for r in records ]
+                    return records
+            except:
+                if ix is None:
+                    raise
+                # -- a query that fails on a healthy replica is retried on the primary, where it fails for real or not
+                if not self._replica_healthy(replica):
+                    logger.warning(f'replica {ix} failed its health check, out for {self.replica_retry}s')
+                    self._replica_down[ix] = time.monotonic() + self.replica_retry
     
+    def _json_path(self, table_meta, param):
+        '''(column, '$.path') when param reaches into a JsonColumn, e.g. data__items__0__sku, otherwise None'''
+        col, _, path = param.partition('__')
+        if not path or not table_meta.json_col_names or col not in table_meta.json_col_names:
+            return None
+        keys = path.split('__')
+        # -- the path is written into the statement (an expression index only matches the same literal)
+        if not all([ re.match(r'^\w+$', k) for k in keys ]):
+            raise Exception(f'{param} is not a usable json path')
+        return col, '$' + ''.join([ f'[{k}]' if k.isdigit() else f'.{k}' for k in keys ])
+
+    def _json_extract(self, table_meta, param):
+        col, path = self._json_path(table_meta, param)
+        return db_dialect_mappings[self.cfg.dbType][Dialect.JSON_VALUE].format(col=col, path=path)
+
+    def _json_value(self, table_meta, param):
+        '''SQL for the scalar at a JsonColumn path, MariaDB's generated column when the path is indexed'''
+        if self.cfg.dbType == DbType.MariaDB and param in (table_meta.json_index_paths or ()):
+            return param
+        return self._json_extract(table_meta, param)
+
+    def _json_generated_column_def(self, table_meta, param):
+        # -- written the way 'show create table' gives it back, so the schema check sees no difference
+        col, path = self._json_path(table_meta, param)
+        return f"{param} varchar(255) GENERATED ALWAYS AS (json_value({col},'{path}')) VIRTUAL"
+
+    def _json_generated_column_defs(self, table_meta):
+        '''mariadb has no expression indexes, each indexed json path gets a virtual column to index instead'''
+        if self.cfg.dbType != DbType.MariaDB:
+            return []
+        return [ self._json_generated_column_def(table_meta, param) for param in table_meta.json_index_paths or () ]
+
+    def _json_generated_column(self, table_meta, param):
+        # -- for tables created before the path was indexed
+        return f'ALTER TABLE {table_meta.table} ADD COLUMN IF NOT EXISTS {self._json_generated_column_def(table_meta, param)}'
+
+    def _index_column(self, table_meta, col_name):
+        if col_name in (table_meta.json_index_paths or ()):
+            return self._json_value(table_meta, col_name)
+        col = next(( c for c in table_meta.user_cols if col_name in [c['name'], f'{c["name"]}_id'] ), None)
+        # -- text, json and unsized string columns can only be indexed on a prefix in some dialects
+        if col and (col['type'].col_type in [text, json] or (col['type'].col_type == str and 'size' not in col['kwargs'])):
+            return f'{col_name}{db_dialect_mappings[self.cfg.dbType][Dialect.INDEX_PREFIX]}'
+        return col_name
+
+    def create_index(self, table_meta, index):
+        return f'CREATE {"UNIQUE " if index["unique"] else ""}INDEX {index["name"]} ON {table_meta.table} ({", ".join([ self._index_column(table_meta, c) for c in index["columns"] ])})'
+
+    def search_table(self, table_meta):
+        return f'{table_meta.table}_fts'
+
+    def search_ddl(self, table_meta):
+        '''Statements creating the full-text index over the table's searchable columns'''
+        if not table_meta.search_col_names:
+            return []
+        cols = ", ".join(table_meta.search_col_names)
+        if self.cfg.dbType == DbType.MariaDB:
+            return [ f'CREATE FULLTEXT INDEX {self.search_table(table_meta)} ON {table_meta.table} ({cols})' ]
+        # -- sqlite: an fts5 table keyed by the row id, kept in step by triggers and filled from the rows already there
+        # -- it keeps its own copy of the text: 'insert or replace' deletes without firing delete triggers, so inserts clear the id first
+        fts = self.search_table(table_meta)
+        new_vals = ", ".join([ f'new.{c}' for c in table_meta.search_col_names ])
+        return [
+            f'CREATE VIRTUAL TABLE {fts} USING fts5({cols})',
+            f'CREATE TRIGGER {fts}_ai AFTER INSERT ON {table_meta.table} BEGIN DELETE FROM {fts} WHERE rowid = new.id; INSERT INTO {fts} (rowid, {cols}) VALUES (new.id, {new_vals}); END',
+            f'CREATE TRIGGER {fts}_au AFTER UPDATE ON {table_meta.table} BEGIN DELETE FROM {fts} WHERE rowid = old.id; INSERT INTO {fts} (rowid, {cols}) VALUES (new.id, {new_vals}); END',
+            f'CREATE TRIGGER {fts}_ad AFTER DELETE ON {table_meta.table} BEGIN DELETE FROM {fts} WHERE rowid = old.id; END',
+            f'INSERT INTO {fts} (rowid, {cols}) SELECT id, {cols} FROM {table_meta.table}'
+        ]
+
+    def init_search(self, table_meta):
+        '''Creates the full-text index for the table's searchable columns when it is missing'''
+        if not table_meta.search_col_names:
+            return
+        if self.cfg.dbType == DbType.MariaDB:
+            exists = self.search_table(table_meta).lower() in self.get_index_names(table_meta.table)
+        else:
+            exists = len(self.raw('select name from sqlite_master where name = ?', (self.search_table(table_meta),))) > 0
+        if exists:
+            return
+        logger.warning(f'Creating the full-text index for {table_meta.table} on {", ".join(table_meta.search_col_names)}')
+        with self.cursor() as c:
+            for statement in self.search_ddl(table_meta):
+                logger.debug(f'executing {statement}')
+                c.execute(statement)
+
+    def _search_terms(self, terms):
+        # -- fts5 reads its own query syntax, quote each word so punctuation in the terms can't break it
+        return " OR ".join([ f'"{word}"' for word in re.findall(r'\w+', terms) ])
+
+    def _search(self, table, terms, limit=20):
+        '''Rows of the table whose searchable columns match the terms, best first, each with a search_score (higher is better)'''
+
+        meta = table._meta
+        cols = ",".join([ f'{meta.table}.{c}' for c in meta.select_col_names ])
+        if self.cfg.dbType == DbType.MariaDB:
+            match = f'match({", ".join(meta.search_col_names)}) against (? in natural language mode)'
+            query = f'select {cols}, {match} as search_score from {meta.table} where {match} order by search_score desc limit ?'
+            params = (terms, terms, limit)
+        else:
+            fts_terms = self._search_terms(terms)
+            if not fts_terms:
+                return []
+            fts = self.search_table(meta)
+            # -- bm25 is lower for better matches
+            query = f'select {cols}, -bm25({fts}) as search_score from {meta.table} inner join {fts} on {fts}.rowid = {meta.table}.id where {fts} match ? order by search_score desc limit ?'
+            params = (fts_terms, limit)
+        logger.info(query)
+        return self._read(query, params, dicts=True)
+
+    def get_index_names(self, table):
+        '''Names of all indexes currently defined on the table, lowercased'''
+        with self.cursor() as c:
+            c.execute(db_dialect_mappings[self.cfg.dbType][Dialect.GET_INDEXES], (table,))
+            return [ (list(r.values()) if type(r) == dict else r)[0].lower() for r in c.fetchall() ]
+
+    def get_table_definitions(self):
+        '''Columns and indexes of every table in the database from a single query, keyed by table name'''
+        definitions = {}
+        with self.cursor() as c:
+            c.execute(db_dialect_mappings[self.cfg.dbType][Dialect.GET_TABLE_DEFINITIONS])
+            rows = [ [ str(v) for v in (r.values() if type(r) == dict else r) ] for r in c.fetchall() ]
+        for row in sorted(rows):
+            definitions.setdefault(row[0].lower(), []).append(" ".join(row[1:]))
+        return { t: "; ".join(definitions[t]) for t in definitions }
+
+    def _strip_index_ddl(self, sql):
+        # -- mariadb folds KEY definitions into 'show create table' while sqlite keeps them out of the table sql
+        # -- indexes are checked on their own, so leave them out of the table comparison
+        lines = [ l for l in sql.split('\n') if not re.match(r'^\s*(UNIQUE |FULLTEXT )?KEY ', l, re.IGNORECASE) ]
+        return re.sub(r',(\s*)\)([^)]*)$', r'\1)\2', '\n'.join(lines))
+
     def init_table(self, table_meta: BaseMeta):
+        '''Creates the table, its indexes and search index as needed, returns False if the existing table doesn't match the code'''
 
         create_table_cmd = f'CREATE TABLE {table_meta.table} {self.create_table(table_meta)} {db_dialect_mappings[self.cfg.dbType][Dialect.ENGINE]}' 
         # f'CREATE TABLE "{table}" {TABLES[table](self.config)}'
 
         sql = None 
+        clean = True
         # -- schemachecker 
         with self.cursor() as c:
             get_create_table_sql = db_dialect_mappings[self.cfg.dbType][Dialect.GET_CREATE_TABLE]
             logger.debug(f'executing {get_create_table_sql} {table_meta.table}')
             try:
-                c.execute(f'{get_create_table_sql} {table_meta.table}')
+                # -- sqlite takes the table name as a parameter, mariadb as part of the statement
+                if '?' in get_create_table_sql:
+                    c.execute(get_create_table_sql, (table_meta.table,))
+                else:
+                    c.execute(f'{get_create_table_sql} {table_meta.table}')
                 # c.execute(f'select sql from sqlite_master where name = ?', (table,))
                 firstrow = c.fetchone()
+                if type(firstrow) == dict:
+                    firstrow = [ table_meta.table, *firstrow.values() ]
                 if not firstrow or len(firstrow) == 0 or not firstrow[1]:
                     # sqlite3.OperationalError
                     raise Exception("fetchone returned nothing")
 
-                sql = firstrow[1]                
+                sql = self._strip_index_ddl(firstrow[1])
                 logger.debug(f'captured {table_meta.table} schema: {sql}')
 
                 sql = " ".join([ s.strip() for s in sql.split(' ') if s.strip() != '' ]).replace('\'', '').replace('`', '').replace('"', '').replace('  ', ' ').lower()
                 create_table_cmd = " ".join([ s.strip() for s in create_table_cmd.split(' ') if s.strip() != '' ]).replace('\'', '').replace('"', '').replace('  ', ' ').lower()
 
                 if sql != create_table_cmd:
+                    clean = False
                     logger.warning(f'WARNING: {table_meta.table} schema in database does not match schema in code\nDatabase:\t{sql}\nCode:\t{create_table_cmd}')
                 else:
                     logger.success(f'Table schema OK')
@@ -238,6 +643,28 @@ class Database(object):
 
         # -sqlite3.OperationalError, mariadb.ProgrammingError
 
+        # -- indexchecker
+        existing_indexes = self.get_index_names(table_meta.table)
+        missing_indexes = [ index for index in table_meta.indexes or [] if index['name'].lower() not in existing_indexes ]
+
+        if missing_indexes:
+            logger.warning(f'WARNING: {table_meta.table} indexes in code are missing from database: {", ".join([ i["name"] for i in missing_indexes ])}')
+        elif table_meta.indexes:
+            logger.success(f'Table indexes OK')
+
+        with self.cursor() as c:
+            for index in missing_indexes:
+                if self.cfg.dbType == DbType.MariaDB:
+                    for path in [ col for col in index['columns'] if col in (table_meta.json_index_paths or ()) ]:
+                        c.execute(self._json_generated_column(table_meta, path))
+                create_index_cmd = self.create_index(table_meta, index)
+                logger.debug(f'executing {create_index_cmd}')
+                c.execute(create_index_cmd)
+
+        self.init_search(table_meta)
+
+        return clean
+
     # def init_db(self):
     #     '''Checks database table schema against table schema definition, creating missing tables'''        
 
@@ -267,12 +694,20 @@ class Database(object):
     #         yield cur 
     #     conn.commit()
 
-    def raw(self, query, params=()):
+    def raw(self, query, params=(), read=False):
+        '''Runs a statement on the primary, or with read=True a read that may be served by a replica'''
 
+        if read:
+            return self._read(query, params)
+
+        # -- there's no telling which tables a raw write touched
+        write = not re.match(r'^\s*(select|explain|show)\b', query, re.IGNORECASE)
         records = []
         with self.cursor() as cur:
             cur.execute(query, params)
             records = cur.fetchall()
+        if write:
+            self._table_changed()
         return records
 
     def _select_cols(self, table):
@@ -294,7 +729,7 @@ class Database(object):
         else:
             raise ValueError(f'cannot render join syntax between {join_table} and {home_table} - foreign key configuration does not associate the two')
     
-    def _parse_param_to_stmt(self, param, val):
+    def _parse_param_to_stmt(self, param, val, table=None):
         op = "="
 
         if param[-4:] == "__gt":
@@ -316,9 +751,41 @@ class Database(object):
             op ="is null" if val else "is not null"
             param = param[0:-8]
 
+        # -- data__status, data__meta__count: a value inside a JsonColumn
+        if table is not None and self._json_path(table._meta, param):
+            param = self._json_value(table._meta, param)
 
+        if op in ["is null", "is not null"]:
+            return f'{param} {op}'
         return f'{param} {op} ?'
 
+    def _where_param(self, table, param, val):
+        if isinstance(val, Enum):
+            return val.name
+        # -- values for json paths keep their type, so numbers compare as numbers
+        if '__' in param and param.split('__')[0] in (table._meta.json_col_names or ()):
+            if isinstance(val, bool) and self.cfg.dbType == DbType.MariaDB:
+                return 'true' if val else 'false'
+            return val
+        # -- numbers and bools bind as themselves, so True matches a stored 1
+        if isinstance(val, (bool, int, float)):
+            return val
+        return str(val)
+
+    def _where(self, table, where):
+        '''The where clause, empty without conditions, and its params: the same for selects and updates'''
+        stmts = []
+        params = []
+        for param in where.keys():
+            val = where[param]
+            # -- a zero or empty string is a value to match, only None is null
+            if val is None:
+                param, val = f'{param}__isnull', True
+            stmts.append(self._parse_param_to_stmt(param, val, table))
+            if param[-8:] != "__isnull":
+                params.append(self._where_param(table, param, val))
+        return ('where ' + ' and '.join(stmts) if stmts else ''), params
+
     TIMESTAMP_LOOKUP = {
         'insert': {
             'created_at': lambda: datetime.utcnow(),
@@ -347,28 +814,26 @@ class Database(object):
             # cols = self.models_by_table_name[table]._meta.select_cols
 
         if join_cols:
+            cols = list(cols)
             for j in joins:
                 cols.extend(self._select_cols(j))
 
         response = _response()
 
         try:
-            params = ()
-            where_stmt = ''
-            if len(where.keys()) > 0:
-                where_stmt = 'where ' + ' and '.join([ self._parse_param_to_stmt(w, where[w]) for w in where.keys() ])
-                params = tuple([ str(where[w]) for w in where ])
+            where_stmt, params = self._where(table, where)
+            params = tuple(params)
             query = f'select {",".join(cols)} from {table._meta.alias} {" ".join([ self._table_join(join, table) for join in joins ])} {where_stmt} '
             if order_by:
                 query = f'{query} order by {order_by}'
 
             logger.info(query)
-            with self.cursor() as cur:
-                cur.execute(query, params)
-                all_records = cur.fetchall()
-                if self.cfg.dbType == DbType.MariaDB:                    
-                    all_records = [ self.dict_factory(cur, row=r) for r in all_records ]                
-                response['data'] = all_records
+            # -- reads inside a transaction may see its uncommitted writes, keep them out of the cache
+            ttl = getattr(table._meta, 'cache_ttl', None)
+            if ttl and not getattr(self._local, 'transaction', None):
+                response['data'] = self._cached_read(table._meta.table, query, params, ttl)
+            else:
+                response['data'] = self._read(query, params, dicts=True)
 
             response['success'] = True 
 
@@ -384,17 +849,32 @@ class Database(object):
         return self.last_response['data']
 
     def _update(self, table, set={}, where={}):
+        '''Sets columns to values or Expressions (computed in the statement) on the rows matching where, returning the number of rows changed'''
 
         response = _response()
 
         try:
-            query = f'update {table._meta.alias} \
-                set {",".join([ k + " = ? " for k in set.keys() ])} \
-                where {" AND ".join([ k + " = ? " if where[k] else k + " is null " for k in where.keys() ])};'
+            set_stmts = []
+            params = []
+            for k in set.keys():
+                if isinstance(set[k], Expression):
+                    sql, expression_params = set[k].compile(self.cfg.dbType)
+                    set_stmts.append(f'{k} = {sql} ')
+                    params.extend(expression_params)
+                else:
+                    set_stmts.append(k + " = ? ")
+                    params.append(set[k])
+            # -- no where updates every row, Model.filter().update() asks for that
+            where_stmt, where_params = self._where(table, where)
+            query = f'update {table._meta.table} \
+                set {",".join(set_stmts)} \
+                {where_stmt};'
             logger.info(query)
-            where = { k: where[k] for k in where.keys() if where[k] }
+            params.extend(where_params)
             with self.cursor() as cur:
-                cur.execute(query, tuple(set.values()) + tuple(where.values()))
+                cur.execute(query, tuple(params))
+                response['data'] = cur.rowcount
+            self._table_changed(table._meta.table)
             response['success'] = True 
         except:
             logger.exception()
@@ -404,7 +884,7 @@ class Database(object):
             raise 
         
         self.last_response = response 
-        return self.last_response['success']
+        return self.last_response['data']
 
     def _delete(self, table, id):
 
@@ -415,6 +895,7 @@ class Database(object):
             logger.info(query)
             with self.cursor() as cur:
                 cur.execute(query, (id,))            
+            self._table_changed(table._meta.table)
             response['success'] = True 
         except:
             logger.exception()
@@ -435,6 +916,54 @@ class Database(object):
             record_id = self.db._insert('images', *params)                    
             return self._select(table, where={'id': record_id})
 
+    LOAD_CONFLICTS = {
+        'error': None,
+        'ignore': Dialect.INSERT_IGNORE,
+        'replace': Dialect.INSERT_REPLACE
+    }
+
+    def _insert_verb(self, on_conflict):
+        if on_conflict not in self.LOAD_CONFLICTS:
+            raise Exception(f'on_conflict must be one of {list(self.LOAD_CONFLICTS.keys())}, got {on_conflict}')
+        return db_dialect_mappings[self.cfg.dbType][self.LOAD_CONFLICTS[on_conflict]] if self.LOAD_CONFLICTS[on_conflict] else 'insert'
+
+    def _insert_many(self, table, cols, rows, on_conflict='error'):
+        '''Inserts a batch of value tuples with one executemany'''
+        query = f'{self._insert_verb(on_conflict)} into {table} ({",".join(cols)}) values({",".join([ "?" for c in cols ])})'
+        with self.cursor() as cur:
+            cur.executemany(query, rows)
+        self._table_changed(table)
+
+    def _infile_value(self, value):
+        if value is None:
+            return '\\N'
+        if isinstance(value, bool):
+            return '1' if value else '0'
+        if isinstance(value, datetime):
+            # -- naive UTC like the insert path, MariaDB would read an offset as garbage
+            if value.tzinfo is not None:
+                value = value.astimezone(UTC).replace(tzinfo=None)
+            value = value.strftime('%Y-%m-%d %H:%M:%S')
+        return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+    def _load_infile(self, table, cols, rows, on_conflict='error'):
+        '''MariaDB LOAD DATA LOCAL INFILE of value tuples, spooled through a tab-separated temp file, returns rows loaded'''
+        self._insert_verb(on_conflict)
+        with tempfile.NamedTemporaryFile('w', suffix='.tsv', delete=False, buffering=1 << 20) as f:
+            for row in rows:
+                f.write("\t".join([ self._infile_value(v) for v in row ]) + "\n")
+        try:
+            conflict = { 'error': '', 'ignore': 'ignore', 'replace': 'replace' }[on_conflict]
+            query = f"load data local infile '{f.name}' {conflict} into table {table} fields terminated by '\\t' escaped by '\\\\' lines terminated by '\\n' ({','.join(cols)})"
+            logger.info(query)
+            with self.cursor() as cur:
+                cur.execute(query)
+                loaded = cur.rowcount
+            self._table_changed(table)
+            return loaded
+        finally:
+            os.remove(f.name)
+
     def _insert(self, table, cols=[], **params):
 
         insert_params = []
@@ -464,6 +993,7 @@ class Database(object):
             with self.cursor() as cur:
                 cur.execute(query, insert_params)    
                 response['data']['insert_id'] = cur.lastrowid
+            self._table_changed(table)
             response['success'] = True 
 
         except:
@@ -1,16 +1,51 @@
+import re
 import simplejson as json
 from datetime import datetime 
 import sqlite3 
 import mariadb
+import threading
+import itertools
 from enum import Enum
 
 class DbType(Enum):
     MariaDB = 0
     Sqlite = 1
 
+SQLITE_SHARED_MEMORY = 'file:frankdb_memory_{}?mode=memory&cache=shared'
+SQLITE_PRAGMAS = ['journal_mode', 'synchronous', 'mmap_size', 'cache_size', 'temp_store', 'busy_timeout']
+
+_sqlite_local = threading.local()
+_sqlite_memory_lock = threading.Lock()
+_sqlite_memory_ids = itertools.count()
+
+def _sqlite_filename(config):
+    if config.filename != ':memory:':
+        return config.filename
+    # -- every thread sees the same :memory: database instead of one each, but each config (e.g. each shard) gets its own
+    with _sqlite_memory_lock:
+        if '_memory_uri' not in config.__dict__:
+            config._memory_uri = SQLITE_SHARED_MEMORY.format(next(_sqlite_memory_ids))
+    return config._memory_uri
+
+def _sqlite_connection(config):
+    '''One long-lived, pragma-tuned connection per thread and database file'''
+
+    filename = _sqlite_filename(config)
+
+    connections = _sqlite_local.__dict__.setdefault('connections', {})
+    if filename not in connections:
+        conn = sqlite3.connect(filename, uri=filename.startswith('file:'), timeout=int(config.busy_timeout) / 1000)
+        for pragma in SQLITE_PRAGMAS:
+            value = str(getattr(config, pragma))
+            if not re.fullmatch(r'-?\w+', value):
+                raise Exception(f'sqlite pragma {pragma} value {value} is not valid')
+            conn.execute(f'pragma {pragma} = {value}')
+        connections[filename] = conn 
+    return connections[filename]
+
 db_providers = {
-    DbType.Sqlite: lambda config: sqlite3.connect(config.filename),
-    DbType.MariaDB: lambda config: mariadb.connect(host=config.host, user=config.user, password=config.password, database=config.name)
+    DbType.Sqlite: _sqlite_connection,
+    DbType.MariaDB: lambda config: mariadb.connect(host=config.host, user=config.user, password=config.password, database=config.name, local_infile=config.local_infile)
 }
 
 class text(str):
@@ -25,6 +60,13 @@ class Dialect(Enum):
     INTEGER = 5
     JSON_TYPE = 6
     TEXT = 7
+    GET_INDEXES = 8
+    INDEX_PREFIX = 9
+    GET_TABLE_DEFINITIONS = 10
+    INSERT_IGNORE = 11
+    INSERT_REPLACE = 12
+    CONCAT = 13
+    JSON_VALUE = 14
 
 # DIALECT_MAPPINGS = {
 #     Dialect.GET_CREATE_TABLE: lambda config: db_dialect_mappings[config.dbType][Dialect.GET_CREATE_TABLE]
@@ -33,15 +75,28 @@ class Dialect(Enum):
 def get_db_connection(config):
     return db_providers[config.dbType](config)
 
+def release_db_connection(config, conn):
+    '''Done with a connection from get_db_connection, sqlite's stay open for the next statement on the thread'''
+    if config.dbType != DbType.Sqlite:
+        conn.close()
+
 db_dialect_mappings = {
     DbType.Sqlite: {
         Dialect.AUTO_INCREMENT: 'autoincrement',            
         Dialect.ENGINE: '',
         Dialect.FLOAT: 'float',
         Dialect.CHAR: 'char',
+        Dialect.TEXT: 'text',
         Dialect.GET_CREATE_TABLE: 'select sql from sqlite_master where name = ?',
-        Dialect.INTEGER: 'int',
-        Dialect.JSON_TYPE: 'json'
+        Dialect.GET_INDEXES: 'select name from sqlite_master where type = \'index\' and tbl_name = ?',
+        Dialect.INDEX_PREFIX: '',
+        Dialect.GET_TABLE_DEFINITIONS: 'select tbl_name, type, sql from sqlite_master where type in (\'table\', \'index\') and sql is not null',
+        Dialect.INTEGER: 'integer',
+        Dialect.JSON_TYPE: 'json',
+        Dialect.INSERT_IGNORE: 'insert or ignore',
+        Dialect.INSERT_REPLACE: 'insert or replace',
+        Dialect.CONCAT: '({} || {})',
+        Dialect.JSON_VALUE: 'json_extract({col}, \'{path}\')'
     },
     DbType.MariaDB: {
         Dialect.AUTO_INCREMENT: 'auto_increment',            
@@ -50,8 +105,18 @@ db_dialect_mappings = {
         Dialect.CHAR: 'varchar',
         Dialect.TEXT: 'text',
         Dialect.GET_CREATE_TABLE: 'show create table',
+        Dialect.GET_INDEXES: 'select distinct index_name from information_schema.statistics where table_schema = database() and table_name = ?',
+        # -- text/blob columns can only be indexed on a prefix 
+        Dialect.INDEX_PREFIX: '(255)',
+        Dialect.GET_TABLE_DEFINITIONS: 'select table_name, column_name, column_type from information_schema.columns where table_schema = database() \
+            union all select table_name, index_name, \'index\' from information_schema.statistics where table_schema = database()',
         Dialect.INTEGER: 'int',
-        Dialect.JSON_TYPE: 'json'
+        Dialect.JSON_TYPE: 'json',
+        Dialect.INSERT_IGNORE: 'insert ignore',
+        Dialect.INSERT_REPLACE: 'replace',
+        Dialect.CONCAT: 'concat({}, {})',
+        # -- json_extract would give strings with their quotes, json_value gives the scalar
+        Dialect.JSON_VALUE: 'json_value({col}, \'{path}\')'
     }
 }
 
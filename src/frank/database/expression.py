@@ -0,0 +1,74 @@
+import re
+from enum import Enum
+from frank.database.dialect import Dialect, db_dialect_mappings
+
+class Expression(object):
+    '''
+    A value the database computes from columns and parameters when the statement runs, e.g. F('counter') + 1.
+    Setting a column to one in an update needs no read first and loses no concurrent changes.
+    '''
+
+    def __init__(self, template, *operands):
+        # -- a format string, or a Dialect, with a {} per operand
+        self.template = template
+        self.operands = operands
+
+    def __add__(self, other):
+        # -- adding a string appends it
+        if isinstance(other, str):
+            return Expression(Dialect.CONCAT, self, other)
+        return Expression('({} + {})', self, other)
+
+    def __radd__(self, other):
+        if isinstance(other, str):
+            return Expression(Dialect.CONCAT, other, self)
+        return Expression('({} + {})', other, self)
+
+    def __sub__(self, other):
+        return Expression('({} - {})', self, other)
+
+    def __rsub__(self, other):
+        return Expression('({} - {})', other, self)
+
+    def __mul__(self, other):
+        return Expression('({} * {})', self, other)
+
+    def __rmul__(self, other):
+        return Expression('({} * {})', other, self)
+
+    def coalesce(self, default):
+        '''The default where the value is null, null + 1 being null'''
+        return Expression('coalesce({}, {})', self, default)
+
+    def compile(self, dbType):
+        '''(sql, params) for the database type'''
+        template = db_dialect_mappings[dbType][self.template] if isinstance(self.template, Dialect) else self.template
+        sqls = []
+        params = []
+        for operand in self.operands:
+            if isinstance(operand, Expression):
+                sql, operand_params = operand.compile(dbType)
+                sqls.append(sql)
+                params.extend(operand_params)
+            else:
+                sqls.append('?')
+                params.append(operand.name if isinstance(operand, Enum) else operand)
+        return template.format(*sqls), params
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.template}, {", ".join([ repr(o) for o in self.operands ])})'
+
+class F(Expression):
+    '''A column's value in the database'''
+
+    def __init__(self, name):
+        if not re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', name):
+            raise Exception(f'{name} is not a column name')
+        super().__init__(name)
+        self.name = name
+
+    def compile(self, dbType):
+        return self.name, []
+
+    def __repr__(self):
+        return f'F({self.name})'
@@ -1,40 +1,113 @@
-import os 
-import cowpy 
-from frank.database.database import Database 
+import os
+import hashlib
+import tempfile
+import threading
+import cowpy
+import simplejson as json
+from concurrent.futures import ThreadPoolExecutor
+from frank.database.database import Database
 from frank.database.model import BaseModel
 from frank.database.config import DatabaseConfig
+from frank.database.dialect import DbType
 from importlib import import_module
 
 logger = cowpy.getLogger()
 
-def setup():
-        
-    # logger.debug(sys.path)
+# -- FRANKDB_SCHEMA_VERIFY
+# -- cached: (default) verify only tables whose code or database definition changed since the last verification
+# -- always: verify every table
+# -- deferred: cached, but in a background thread after setup() returns
+# -- off: skip verification
+SCHEMA_VERIFY_MODES = ['cached', 'always', 'deferred', 'off']
+SCHEMA_VERIFY_WORKERS_DEFAULT = 4
+SCHEMA_CACHE_DEFAULT = os.path.join(tempfile.gettempdir(), 'frankdb_schema.json')
 
-    # settings_module_name = os.getenv('FRANKDB_SETTINGS')
-    # settings = None 
+def _read_schema_cache(cache_file):
+    try:
+        with open(cache_file, 'r') as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return {}
 
-    # if settings_module_name:
-    #     settings = import_module(settings_module_name)
+def _write_schema_cache(cache_file, contents):
+    # -- write aside and swap in, so a concurrent reader never sees a partial file
+    tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(json.dumps(contents))
+    os.replace(tmp_file, cache_file)
 
-    # frankdb_models_module = settings.FRANKDB_MODELS
+def _schema_cache_key(cfg):
+    return f'{cfg.dbType.name}:{cfg.host}:{cfg.name}:{cfg.filename}'
 
-    models_module_name = os.getenv('FRANKDB_MODELS')
-    logger.info(f'Loading models: {models_module_name}')
+def _schema_fingerprint(db, model, definitions):
+    '''Hash of the table as declared in code and as found in the database'''
+    code = " ".join([ db.create_table(model._meta), *[ db.create_index(model._meta, i) for i in model._meta.indexes ], *db.search_ddl(model._meta) ])
+    return hashlib.sha256(f'{code}|{definitions.get(model._meta.table)}|{definitions.get(db.search_table(model._meta))}'.encode()).hexdigest()
+
+def _verify_database_schema(db, models, schema_cache, use_cache):
+
+    cache_key = _schema_cache_key(db.cfg)
+    cached = schema_cache.get(cache_key, {}) if use_cache else {}
+
+    definitions = db.get_table_definitions()
+    stale = [ m for m in models if cached.get(m._meta.table) != _schema_fingerprint(db, m, definitions) ]
+
+    logger.info(f'Verifying {len(stale)} of {len(models)} tables')
+
+    drifted = []
+    if stale:
+        workers = int(os.getenv('FRANKDB_SCHEMA_WORKERS', SCHEMA_VERIFY_WORKERS_DEFAULT))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            drifted = [ m for m, clean in zip(stale, pool.map(lambda m: db.init_table(m._meta), stale)) if not clean ]
+        # -- init_table may have created tables or indexes
+        definitions = db.get_table_definitions()
+
+    # -- tables that still don't match the code are left out, so they are verified (and warned about) again next time
+    schema_cache[cache_key] = { m._meta.table: _schema_fingerprint(db, m, definitions) for m in models if m not in drifted }
+
+def verify_schema(models, use_cache=True):
+    '''Runs init_table for models whose schema fingerprint is not in the local cache, a few tables at a time, on each database (or shard) holding them'''
+
+    placements = {}
+    for m in models:
+        for db in Database.getInstance().route(m._meta):
+            placements.setdefault(id(db), (db, []))[1].append(m)
+
+    cache_file = os.getenv('FRANKDB_SCHEMA_CACHE', SCHEMA_CACHE_DEFAULT)
+    schema_cache = _read_schema_cache(cache_file)
+    for db, db_models in placements.values():
+        _verify_database_schema(db, db_models, schema_cache, use_cache)
+    _write_schema_cache(cache_file, schema_cache)
+
+def load_models(models_module_name):
     t = import_module(models_module_name)
 
     # logger.debug(t)
     # logger.debug(dir(t))
 
+    models = []
     for d in dir(t):
         sub = t.__getattribute__(d)
-        # logger.debug(f'Testing attribute {sub}')    
+        # logger.debug(f'Testing attribute {sub}')
         is_sub = type(sub) == type and issubclass(sub, BaseModel) and sub != BaseModel
-        if is_sub:        
+        if is_sub:
             logger.info(f'Init: {sub}')
-            sub.init()
+            models.append(sub)
+    return models
 
-    ## - DATABASE CONFIG 
+def setup():
+
+    # logger.debug(sys.path)
+
+    # settings_module_name = os.getenv('FRANKDB_SETTINGS')
+    # settings = None
+
+    # if settings_module_name:
+    #     settings = import_module(settings_module_name)
+
+    # frankdb_models_module = settings.FRANKDB_MODELS
+
+    ## - DATABASE CONFIG
 
     DB_PARAMS = [
         'DB_USER',
@@ -44,12 +117,42 @@ def setup():
         'DB_TYPE'
     ]
     params = { p: os.getenv(p.upper()) for p in DB_PARAMS }
-    
+
     if not all(params.values()):
         raise EnvironmentError(f'Not all db values were provided: {params}')
-    
+
+    verify_mode = os.getenv('FRANKDB_SCHEMA_VERIFY', 'cached').lower()
+    if verify_mode not in SCHEMA_VERIFY_MODES:
+        raise EnvironmentError(f'FRANKDB_SCHEMA_VERIFY must be one of {SCHEMA_VERIFY_MODES}, got {verify_mode}')
+
     logger.debug(f'Loading database config: {params}')
     config = DatabaseConfig(**params)
-    Database.createInstance(config)
 
-    return True 
+    # -- DB_REPLICAS: comma-separated replica hosts (mariadb) or filenames (sqlite), otherwise configured like the primary
+    replica_key = 'filename' if config.dbType == DbType.Sqlite else 'host'
+    replicas = [ DatabaseConfig(**{ **params, replica_key: r.strip() }) for r in os.getenv('DB_REPLICAS', '').split(',') if r.strip() ]
+    if replicas:
+        logger.info(f'Reading from {len(replicas)} replicas')
+
+    # -- DB_SHARDS: comma-separated shard hosts or filenames, each optionally named, e.g. archive=db2,db3
+    shard_entries = [ s.strip() for s in os.getenv('DB_SHARDS', '').split(',') if s.strip() ]
+    shards = {}
+    for i, entry in enumerate(shard_entries):
+        name, target = entry.split('=', 1) if '=' in entry else (str(i), entry)
+        shards[name.strip()] = DatabaseConfig(**{ **params, replica_key: target.strip() })
+    if shards:
+        logger.info(f'Sharding across {", ".join(shards.keys())}')
+
+    Database.createInstance(config, replicas=replicas, shards=shards)
+
+    models_module_name = os.getenv('FRANKDB_MODELS')
+    logger.info(f'Loading models: {models_module_name}')
+    models = load_models(models_module_name)
+    Database.getInstance().models = models
+
+    if verify_mode == 'deferred':
+        threading.Thread(target=verify_schema, args=(models,), daemon=True).start()
+    elif verify_mode != 'off':
+        verify_schema(models, use_cache=verify_mode == 'cached')
+
+    return True
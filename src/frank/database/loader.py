@@ -0,0 +1,67 @@
+import csv
+import gzip
+import cowpy
+import simplejson as json
+from datetime import datetime
+from frank.database.dialect import text
+
+logger = cowpy.getLogger()
+
+LOAD_FORMATS = ['csv', 'ndjson']
+
+def file_format(path):
+    '''csv or ndjson, from the file extension under any .gz'''
+    name = path[:-3] if path.endswith('.gz') else path
+    if name.endswith('.csv'):
+        return 'csv'
+    if name.endswith('.ndjson') or name.endswith('.jsonl') or name.endswith('.json'):
+        return 'ndjson'
+    raise Exception(f'Cannot tell the format of {path}, pass one of {LOAD_FORMATS}')
+
+def read_records(path, format=None):
+    '''Dicts from a csv (by its header) or ndjson file, gzip'd or not, read one at a time'''
+    format = format or file_format(path)
+    if format not in LOAD_FORMATS:
+        raise Exception(f'Load format must be one of {LOAD_FORMATS}, got {format}')
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', newline='') as f:
+        if format == 'csv':
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+def _bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ['1', 'true', 't', 'yes', 'y']
+    return bool(value)
+
+def _datetime(value):
+    return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+
+def _json(value):
+    # -- json columns hold the serialized document
+    return value if isinstance(value, str) else json.dumps(value)
+
+COERCIONS = {
+    str: str,
+    text: str,
+    int: int,
+    float: float,
+    bool: _bool,
+    json: _json,
+    datetime.date: _datetime,
+    'identity': int,
+    'foreign_key': int
+}
+
+def coercer(col_type):
+    '''Converts a file value to a column's col_type, empty csv fields are null except in string columns'''
+    convert = COERCIONS[col_type] if col_type in COERCIONS else (lambda value: value)
+    keep_empty = col_type in [str, text]
+    def coerce(value):
+        if value is None or (value == '' and not keep_empty):
+            return None
+        return convert(value)
+    return coerce
@@ -6,8 +6,27 @@ class BaseMeta:
     identity_col = None
     built_in_cols = None
     user_cols = None
+    built_in_col_names = None
+    user_col_names = None
+    built_in_col_specs = None
+    user_col_specs = None
     insert_col_names = None
     select_col_names = None
+    indexes = None
+    # -- JsonColumn names, whose contents get() can filter on: data__status='ok'
+    json_col_names = None
+    # -- indexed paths into JsonColumns, e.g. data__status
+    json_index_paths = None
+    # -- columns declared searchable=True, full-text indexed for search()
+    search_col_names = None
+    # -- the name of the shard holding the whole table
+    shard = None
+    # -- the column whose value picks the shard holding each row
+    shard_key = None
+    # -- seconds get() results are served from the Database result cache, None to always query
+    cache_ttl = None
+    # -- a WriteBehind when save() only queues the row
+    write_behind = None
 
     def __init__(self, *args, **kwargs):
         for k in kwargs:
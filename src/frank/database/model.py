@@ -1,13 +1,23 @@
 # import sys 
+import re
+import time
 import cowpy
+import itertools
+import simplejson as json
 # import importlib
 # import gc 
 from datetime import datetime 
+from pytz import timezone
+from contextlib import ExitStack
 
 from frank.database.meta import BaseMeta, InstanceMeta
 from frank.database.database import Database 
 from frank.database.column import Column, DateTimeColumn, ForeignKey, IdentityColumn
-from frank.database.query import Query 
+from frank.database.query import Query, ModelFilter
+from frank.database.expression import F
+from frank.database.dialect import DbType, text
+from frank.database.loader import read_records, coercer
+from frank.database.writebehind import WriteBehind
 
 logger = cowpy.getLogger()
 
@@ -25,80 +35,147 @@ class BaseModel:
     _meta: BaseMeta = None 
     _instancemeta: InstanceMeta = None 
 
+    def __init_subclass__(cls, **kwargs):
+        '''Builds the class _meta once, when the model class is defined'''
+
+        super().__init_subclass__(**kwargs)
+
+        column_type_attrs = [ attr_name
+            for attr_name in dir(cls) 
+            if isinstance(getattr(cls, attr_name), Column)
+        ]
+
+        built_in_cols = [
+            {
+                'name': 'created_at',
+                'type': DateTimeColumn,
+                'kwargs': {'mark': 'create'}
+            },
+            {
+                'name': 'updated_at',
+                'type': DateTimeColumn,
+                'kwargs': {'mark': 'update'}
+            }
+        ]
+                
+        user_cols = [
+            {
+                'name': a, 
+                'type': type(getattr(cls, a)),
+                'kwargs': getattr(cls, a).kwargs
+            } for a in column_type_attrs
+        ]
+        
+        insert_col_names = [ 
+            f'{col["name"]}_id' if issubclass(col["type"], ForeignKey) else col["name"] 
+            for col in user_cols 
+        ]
+        insert_col_names.extend([ f'{col["name"]}' for col in built_in_cols ])
+
+        select_col_names = [ 'id' ]
+        select_col_names.extend(insert_col_names)
+
+        # -- TestieWidgets -> testie_widgets
+        table = re.sub(r'(?<!^)([A-Z])', r'_\1', cls.__name__).lower()
+
+        # table = cls.__name__.lower() + "s"
+        alias = f'{table} {table[0]}'
+
+        # -- per-column index=True/unique=True and composite indexes declared on an inner Meta:
+        # -- class Meta:
+        # --     indexes = [ 'name', ('name', 'counter'), {'columns': ['name', 'value'], 'unique': True} ]
+        # -- paths into a JsonColumn can be indexed too, e.g. 'data__status' for data's status key
+        index_decls = [ 
+            {'columns': [col['name']], 'unique': 'unique' in col['kwargs'] and col['kwargs']['unique']}
+            for col in user_cols 
+            if any([ k in col['kwargs'] and col['kwargs'][k] for k in ['index', 'unique'] ])
+        ]
+        
+        model_meta = getattr(cls, 'Meta', None)
+        for decl in getattr(model_meta, 'indexes', None) or []:
+            if type(decl) == str:
+                decl = {'columns': [decl]}
+            elif type(decl) in [list, tuple]:
+                decl = {'columns': list(decl)}
+            index_decls.append(decl)
+
+        index_col_names = { col['name']: insert_col_names[i] for i, col in enumerate(user_cols) }
+        json_col_names = tuple([ col['name'] for col in user_cols if col['type'].col_type == json ])
+        json_index_paths = []
+        indexes = []
+        for decl in index_decls:
+            paths = [ c for c in decl['columns'] if c not in index_col_names and '__' in c and c.split('__')[0] in json_col_names ]
+            unknown = [ c for c in decl['columns'] if c not in index_col_names and c not in paths ]
+            if unknown:
+                raise Exception(f'{cls.__name__} index on {unknown} does not reference declared columns')
+            json_index_paths.extend([ p for p in paths if p not in json_index_paths ])
+            unique = 'unique' in decl and decl['unique']
+            columns = [ index_col_names[c] if c in index_col_names else c for c in decl['columns'] ]
+            indexes.append({
+                'name': decl['name'] if 'name' in decl else f'{"ux" if unique else "ix"}_{table}_{"_".join(columns)}',
+                'columns': columns,
+                'unique': unique
+            })
+
+        # -- name = StringColumn(size=100, searchable=True), body = TextColumn(searchable=True)
+        search_col_names = tuple([ insert_col_names[i] for i, col in enumerate(user_cols) if 'searchable' in col['kwargs'] and col['kwargs']['searchable'] ])
+        not_text = [ col['name'] for col in user_cols if col['name'] in search_col_names and col['type'].col_type not in [str, text] ]
+        if not_text:
+            raise Exception(f'{cls.__name__} columns {not_text} are not string or text columns and can\'t be searchable')
+
+        # -- class Meta:
+        # --     shard = 'archive'        (the whole table lives on one shard)
+        # --     shard_key = 'tenant_id'  (rows are spread across all shards by a hash of the column)
+        shard = getattr(model_meta, 'shard', None)
+        shard_key = getattr(model_meta, 'shard_key', None)
+        if shard and shard_key:
+            raise Exception(f'{cls.__name__} can have a shard or a shard_key, not both')
+        if shard_key and shard_key not in index_col_names:
+            raise Exception(f'{cls.__name__} shard_key {shard_key} does not reference a declared column')
+
+        cls._meta = BaseMeta(
+            table=table, 
+            alias=alias,
+            identity_col={'name': 'id', 'type': IdentityColumn},
+            built_in_cols=built_in_cols,
+            user_cols=user_cols,
+            built_in_col_names=tuple([ col['name'] for col in built_in_cols ]),
+            user_col_names=tuple([ col['name'] for col in user_cols ]),
+            built_in_col_specs=tuple([ (col['name'], col['type'], col['kwargs']) for col in built_in_cols ]),
+            user_col_specs=tuple([ (col['name'], col['type'], col['kwargs']) for col in user_cols ]),
+            insert_col_names=tuple(insert_col_names),
+            select_col_names=tuple(select_col_names),
+            indexes=indexes,
+            json_col_names=json_col_names,
+            json_index_paths=tuple(json_index_paths),
+            search_col_names=search_col_names,
+            shard=shard,
+            shard_key=shard_key,
+            # -- class Meta:
+            # --     cache_ttl = 300  (seconds, for tables read far more than written)
+            cache_ttl=getattr(model_meta, 'cache_ttl', None),
+            joins=[]
+        )
+
+        # -- class Meta:
+        # --     write_behind = True  (or a dict of WriteBehind settings, e.g. {'batch_rows': 1000})
+        write_behind = getattr(model_meta, 'write_behind', None)
+        if write_behind:
+            cls._meta.write_behind = WriteBehind(cls, **(write_behind if type(write_behind) == dict else {}))
+
     def __init__(self, *args, **kwargs):
         
         # logger.debug(f'BaseModel: instantiating new {self.__class__.__name__}')        
 
-        if self.__class__._meta is None:
-                
-            column_type_attrs = [ attr_name
-                for attr_name in self.__dir__() 
-                if isinstance(self.__getattribute__(attr_name), Column)
-            ]
-
-            built_in_cols = [
-                {
-                    'name': 'created_at',
-                    'type': DateTimeColumn,
-                    'kwargs': {'mark': 'create'}
-                },
-                {
-                    'name': 'updated_at',
-                    'type': DateTimeColumn,
-                    'kwargs': {'mark': 'update'}
-                }
-            ]
-                    
-            user_cols = [
-                {
-                    'name': a, 
-                    'type': type(self.__getattribute__(a)),
-                    'kwargs': self.__getattribute__(a).kwargs
-                } for a in column_type_attrs
-            ]
-            
-            insert_col_names = [ 
-                f'{col["name"]}_id' if isinstance(self.__getattribute__(col["name"]), ForeignKey) else col["name"] 
-                for col in user_cols 
-            ]
-            insert_col_names.extend([ f'{col["name"]}' for col in built_in_cols ])
-
-            select_col_names = [ 'id' ]
-            select_col_names.extend(insert_col_names)
-            
-            import re 
-
-            table = ''
-            for i, c in enumerate(self.__class__.__name__, 0):
-                if i == 0:
-                    table = c.lower()
-                    continue 
-                if re.match("[A-Z]", c):
-                    table += f'_{c.lower()}'
-                else:
-                    table += f'{c}'
-                    
-            # table = self.__class__.__name__.lower() + "s"
-            alias = f'{table} {table[0]}'
-
-            self.__class__._meta = BaseMeta(
-                table=table, 
-                alias=alias,
-                identity_col={'name': 'id', 'type': IdentityColumn},
-                built_in_cols=built_in_cols,
-                user_cols=user_cols,
-                insert_col_names=insert_col_names,
-                select_col_names=select_col_names,
-                joins=[]
-            )
+        meta = self.__class__._meta
 
         self._instancemeta = InstanceMeta()
 
-        self._instancemeta.identity_col = { 'name': self.__class__._meta.identity_col["name"], 'col': self.__class__._meta.identity_col["type"]() }
-        self._instancemeta.built_in_cols = [ { 'name': col["name"], 'col': col["type"](**col["kwargs"]) } for col in self.__class__._meta.built_in_cols ]
-        self._instancemeta.user_cols = [ { 'name': col["name"], 'col': col["type"](**col["kwargs"]) } for col in self.__class__._meta.user_cols ]
-        self._instancemeta.built_in_col_lookup = { col['name']: col for col in self._instancemeta.built_in_cols }
-        self._instancemeta.user_col_lookup = { col['name']: col for col in self._instancemeta.user_cols }
+        self._instancemeta.identity_col = { 'name': meta.identity_col["name"], 'col': meta.identity_col["type"]() }
+        self._instancemeta.built_in_cols = [ { 'name': name, 'col': col_type(**col_kwargs) } for name, col_type, col_kwargs in meta.built_in_col_specs ]
+        self._instancemeta.user_cols = [ { 'name': name, 'col': col_type(**col_kwargs) } for name, col_type, col_kwargs in meta.user_col_specs ]
+        self._instancemeta.built_in_col_lookup = dict(zip(meta.built_in_col_names, self._instancemeta.built_in_cols))
+        self._instancemeta.user_col_lookup = dict(zip(meta.user_col_names, self._instancemeta.user_cols))
 
         # logger.debug(f'looking to set the value of each of {kwargs} as identity id, built-in {built_in_cols.keys()}, or user-defined column {user_def_col_names}')
         for k in kwargs:
@@ -205,6 +282,14 @@ class BaseModel:
     # def register_db(cls, db: Database):
     #     cls._meta.db = db 
 
+    def _database(self):
+        '''The one database that owns this row'''
+        values = { name: self._instancemeta.user_col_lookup[name]['col'].val for name in self.__class__._meta.user_col_names }
+        databases = Database.getInstance().route(self.__class__._meta, values)
+        if len(databases) > 1:
+            raise Exception(f'{self.__class__.__name__} has no {self.__class__._meta.shard_key} value to pick its shard')
+        return databases[0]
+
     @classmethod 
     def only(cls, **kwargs):
         records = cls.get(**kwargs)
@@ -221,9 +306,74 @@ class BaseModel:
 
     @classmethod 
     def init(cls):
-        cls()
         Database.getInstance().init_table(cls._meta)
 
+    @classmethod 
+    def load_file(cls, path, format=None, batch_size=5000, on_conflict='error'):
+        '''
+        Bulk loads a csv or ndjson file, gzip'd or not, returning the number of rows loaded.
+        Values are coerced to the column types, missing timestamps are set to now and ids are kept when the file has them.
+        on_conflict: error, ignore or replace rows that collide on the primary key or a unique index.
+        '''
+
+        meta = cls._meta
+        records = read_records(path, format)
+        first = next(records, None)
+        if first is None:
+            return 0
+
+        # -- (column, key in the file when not the column name, coerce)
+        fields = [ (insert_name, name, coercer(col_class.col_type)) for (name, col_class, _), insert_name in zip(meta.user_col_specs, meta.insert_col_names) ]
+        if meta.identity_col['name'] in first:
+            fields.insert(0, (meta.identity_col['name'], meta.identity_col['name'], coercer(meta.identity_col['type'].col_type)))
+        stamps = [ (name, coercer(col_class.col_type)) for name, col_class, _ in meta.built_in_col_specs ]
+        cols = [ f[0] for f in fields ] + [ s[0] for s in stamps ]
+
+        now = datetime.now(timezone('UTC'))
+        def to_row(record):
+            values = [ coerce(record[insert_name] if insert_name in record else record.get(name)) for insert_name, name, coerce in fields ]
+            values.extend([ coerce(record.get(name)) or now for name, coerce in stamps ])
+            return tuple(values)
+        rows = ( to_row(r) for r in itertools.chain([ first ], records) )
+
+        db = Database.getInstance()
+        databases = db.route(meta)
+        started = time.monotonic()
+
+        def report(loaded):
+            elapsed = time.monotonic() - started
+            logger.info(f'{meta.table}: {loaded} rows loaded ({loaded / elapsed if elapsed else loaded:.0f} rows/s)')
+
+        # -- mariadb's own loader, when the connection allows it
+        if len(databases) == 1 and databases[0].cfg.dbType == DbType.MariaDB and databases[0].cfg.local_infile:
+            loaded = databases[0]._load_infile(meta.table, cols, rows, on_conflict=on_conflict)
+            report(loaded)
+            return loaded
+
+        # -- otherwise executemany batches, all in one transaction per database
+        shard_ix = cols.index(dict(zip(meta.user_col_names, meta.insert_col_names))[meta.shard_key]) if len(databases) > 1 else None
+        loaded = 0
+        with ExitStack() as transactions:
+            opened = set()
+            while True:
+                batch = list(itertools.islice(rows, batch_size))
+                if not batch:
+                    break
+                by_database = {}
+                for row in batch:
+                    if shard_ix is not None and row[shard_ix] is None:
+                        raise Exception(f'{cls.__name__} row has no {meta.shard_key} value to pick its shard: {row}')
+                    target = databases[0] if shard_ix is None else db.shard_for(row[shard_ix])
+                    by_database.setdefault(id(target), (target, []))[1].append(row)
+                for target, target_rows in by_database.values():
+                    if id(target) not in opened:
+                        transactions.enter_context(target.transaction())
+                        opened.add(id(target))
+                    target._insert_many(meta.table, cols, target_rows, on_conflict=on_conflict)
+                loaded += len(batch)
+                report(loaded)
+        return loaded
+
     @classmethod 
     def all(cls):
         return cls.get()
@@ -240,6 +390,22 @@ class BaseModel:
             for r in records:
                 r.delete()
 
+    @classmethod 
+    def search(cls, terms, limit=20):
+        '''Rows whose searchable columns match any of the terms, most relevant first'''
+        if not cls._meta.search_col_names:
+            raise Exception(f'{cls.__name__} has no searchable columns')
+        db = Database.getInstance()
+        records = [ r for shard_records in db.scatter(db.route(cls._meta), lambda d: d._search(cls, terms, limit)) for r in shard_records ]
+        # -- each shard gives its own best, keep the best of those
+        records.sort(key=lambda r: r['search_score'], reverse=True)
+        return [ cls(**r) for r in records[:limit] ]
+
+    @classmethod 
+    def filter(cls, **kwargs):
+        '''The rows matching kwargs (as get() takes them), to change in place with update()'''
+        return ModelFilter(cls, kwargs)
+
     @classmethod 
     def join(cls, **kwargs):
         return Query(cls, **kwargs)        
@@ -247,7 +413,9 @@ class BaseModel:
     @classmethod
     def get(cls, **kwargs):
         
-        records = Database.getInstance()._select(cls, joins=cls._meta.joins, join_cols=False, cols=cls._meta.select_col_names, where=kwargs)        
+        # -- one shard when the shard key is given, otherwise every shard the table lives on
+        db = Database.getInstance()
+        records = [ r for shard_records in db.scatter(db.route(cls._meta, kwargs), lambda d: d._select(cls, joins=cls._meta.joins, join_cols=False, cols=cls._meta.select_col_names, where=kwargs)) for r in shard_records ]
         # records = cls._meta.db._select(table_name, where=kwargs)
         
         # logger.debug(records)
@@ -317,9 +485,11 @@ class BaseModel:
         # logger.debug(f'upsert kwargs {upsert_on}')
         dbrecords = []        
         
+        db = self._database()
+
         # if presented with any query, we look for a singular database record to update
         if len(upsert_on) > 0:
-            dbrecords = Database.getInstance()._select(self.__class__, cols=self.__class__._meta.select_col_names, where=upsert_on)
+            dbrecords = db._select(self.__class__, cols=self.__class__._meta.select_col_names, where=upsert_on)
 
         # if we find that singular record, update with our column vals
         if len(dbrecords) == 1:
@@ -328,14 +498,14 @@ class BaseModel:
             logger.info(f'updating db record with {vals}')
             dbrecords[0].update(vals)
             id_match = self._id_col_val or dbrecords[0]['id']
-            Database.getInstance()._update(self.__class__, set=dbrecords[0], where={'id':id_match})
+            db._update(self.__class__, set=dbrecords[0], where={'id':id_match})
             # self._instancemeta.identity_col['col'].set_val(dbrecords[0]['id'])
             # -- the timestamps are the only values that possibly vary during this operation (dynamically set from val_dict)
             for builtin in [ c for c in self.__class__._meta.built_in_cols if 'mark' in c['kwargs'] and c['kwargs']['mark'] in ['create', 'update'] ]:
                 self._instancemeta.built_in_col_lookup[builtin['name']]['col'].set_val(vals[builtin['name']])
         elif len(dbrecords) == 0:
             vals = self.val_dict(operation='insert')
-            insert_response = Database.getInstance()._insert(
+            insert_response = db._insert(
                 table=self.__class__._meta.table, 
                 cols=self.__class__._meta.insert_col_names, 
                 **vals
@@ -346,18 +516,39 @@ class BaseModel:
         else:
             raise Exception(f'upserting {self.__class__.__name__} with {kwargs} matched {len(dbrecords)} records')
     
+    def increment(self, name, by=1):
+        '''Adds to a column in a single update, so concurrent increments aren't lost; the instance only sees its own'''
+        if self._id_col_val is None:
+            raise Exception(f'{self.__class__.__name__} has to be saved before it can be incremented')
+        ModelFilter(self.__class__, { 'id': self._id_col_val }, databases=[ self._database() ]).update(**{ name: F(name).coalesce(0) + by })
+        setattr(self, name, (getattr(self, name) or 0) + by)
+
     def set(self, **kwargs):
         for k in kwargs:
             if hasattr(self, k):
                 setattr(self, k, kwargs[k])
                 
     def delete(self):
-        Database.getInstance()._delete(
+        self._database()._delete(
             table=self.__class__,
             id=self._instancemeta.identity_col['col'].val
         )
 
+    @classmethod
+    def write_behind(cls, enabled=True, **kwargs):
+        '''Turns buffered background saves on, with WriteBehind settings, or off, writing out what is buffered; returns the writer'''
+        if cls._meta.write_behind:
+            try:
+                cls._meta.write_behind.close()
+            finally:
+                cls._meta.write_behind = None
+        cls._meta.write_behind = WriteBehind(cls, **kwargs) if enabled else None
+        return cls._meta.write_behind
+
     def save(self):
+        if self.__class__._meta.write_behind:
+            self.__class__._meta.write_behind.put(self)
+            return
         upsert_kwargs = {}
         if self._instancemeta.identity_col['col'].val is not None:
             upsert_kwargs['id'] = self._instancemeta.identity_col['col'].val
@@ -1,3 +1,6 @@
+from datetime import datetime
+from pytz import timezone
+from frank.database.database import Database
 
 
 class Query:
@@ -30,4 +33,33 @@ class Query:
     def join(self, base_class, **kwargs):
         self.joins.append({**kwargs, 'base': base_class})
         return self 
-        
\ No newline at end of file
+        
+class ModelFilter:
+    '''The rows of a model matching a where, changed with one statement per database, e.g. Model.filter(id=1).update(counter=F('counter') + 1)'''
+
+    def __init__(self, model, where, databases=None):
+        self.model = model
+        self.where = where
+        # -- the databases holding the rows, when the caller already knows them
+        self.databases = databases
+
+    def get(self):
+        return self.model.get(**self.where)
+
+    def update(self, **values):
+        '''Sets columns to values or expressions (F), returning the number of rows changed'''
+
+        meta = self.model._meta
+        unknown = [ k for k in values if k not in meta.insert_col_names ]
+        if unknown:
+            raise Exception(f'{self.model.__name__} has no columns {", ".join(unknown)}')
+        if meta.shard_key and meta.shard_key in values:
+            raise Exception(f'{self.model.__name__} rows can\'t change their shard key {meta.shard_key}')
+
+        for name, col_class, col_kwargs in meta.built_in_col_specs:
+            if name not in values and col_kwargs.get('mark') == 'update':
+                values[name] = datetime.now(timezone('UTC'))
+
+        db = Database.getInstance()
+        databases = self.databases or db.route(meta, self.where)
+        return sum(db.scatter(databases, lambda d: d._update(self.model, set=values, where=self.where)))
@@ -0,0 +1,157 @@
+import time
+import queue
+import atexit
+import cowpy
+import threading
+from enum import Enum
+from frank.database.database import Database
+
+logger = cowpy.getLogger()
+
+class WriteBehind(object):
+    '''
+    Buffers a model's saves and writes them from a background thread in multi-row batches.
+    Saved instances get no id, rows with an id replace the stored row.
+    Batches that fail to write go to on_error, or without one are kept in failed and raised from the next flush().
+    '''
+
+    # -- rows the buffer holds before save() blocks
+    max_rows = 10000
+    # -- seconds save() waits on a full buffer before raising, None waits for room
+    put_timeout = None
+    # -- a batch is written at this many rows, or this long after its first row
+    batch_rows = 500
+    interval_ms = 200
+    # -- on_error(exception, rows) for a batch that failed to write, rows as dicts
+    on_error = None
+    # -- (exception, rows) for batches that failed with no on_error to take them
+    failed = None
+
+    def __init__(self, model, **kwargs):
+        for k in kwargs:
+            self.__setattr__(k, kwargs[k])
+        self.model = model
+        self._queue = queue.Queue(maxsize=self.max_rows)
+        self._flushing = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self.failed = []
+        self._reported = 0
+        # -- rows queued and rows written so far, flush() waits for the written count to reach the queued count it started with
+        self._put_lock = threading.Lock()
+        self._queued = 0
+        self._written = 0
+        self._written_changed = threading.Condition()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f'write-behind-{self.model._meta.table}', daemon=True)
+                self._thread.start()
+                # -- unregistered in close()
+                atexit.register(self.close)
+
+    def put(self, instance):
+        '''Queues the instance's current values, blocking (backpressure) while the buffer is full'''
+
+        meta = self.model._meta
+        vals = instance.val_dict(operation='insert')
+        for builtin in [ c for c in meta.built_in_cols if 'mark' in c['kwargs'] and c['kwargs']['mark'] in ['create', 'update'] ]:
+            instance._instancemeta.built_in_col_lookup[builtin['name']]['col'].set_val(vals[builtin['name']])
+
+        cols = meta.insert_col_names
+        row = tuple([ v.name if isinstance(v, Enum) else v for v in vals.values() ])
+        if instance._id_col_val is not None:
+            cols = (meta.identity_col['name'], *cols)
+            row = (instance._id_col_val, *row)
+
+        # -- pick the database now, so a row that can't be routed fails in the caller
+        target = instance._database()
+
+        # -- counted along with the put, so the count never runs ahead of the queue order
+        # -- and checked against close() under the same lock, so no row lands after the final flush
+        with self._put_lock:
+            if self._closed:
+                raise Exception(f'{self.model.__name__} write-behind is closed')
+            self._start()
+            try:
+                self._queue.put((target, cols, row), timeout=self.put_timeout)
+            except queue.Full:
+                raise Exception(f'{self.model.__name__} write-behind buffer is full ({self.max_rows} rows)')
+            self._queued += 1
+
+    def _write(self, batch):
+        groups = {}
+        for target, cols, row in batch:
+            groups.setdefault((id(target), cols), (target, cols, []))[2].append(row)
+        for target, cols, rows in groups.values():
+            on_conflict = 'replace' if cols[0] == self.model._meta.identity_col['name'] else 'error'
+            try:
+                target._insert_many(self.model._meta.table, cols, rows, on_conflict=on_conflict)
+            except Exception as e:
+                logger.exception()
+                failed_rows = [ dict(zip(cols, row)) for row in rows ]
+                if self.on_error:
+                    try:
+                        self.on_error(e, failed_rows)
+                        continue
+                    except:
+                        logger.exception()
+                with self._lock:
+                    self.failed.append((e, failed_rows))
+
+    def _run(self):
+        interval = self.interval_ms / 1000
+        while not (self._closed and self._queue.empty()):
+            try:
+                batch = [ self._queue.get(timeout=interval) ]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + interval
+            while len(batch) < self.batch_rows:
+                try:
+                    # -- take what is there right away when asked to flush
+                    if self._flushing.is_set() or self._closed:
+                        batch.append(self._queue.get_nowait())
+                    else:
+                        batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            finally:
+                with self._written_changed:
+                    self._written += len(batch)
+                    self._written_changed.notify_all()
+
+    def flush(self):
+        '''Blocks until everything queued before the call is written, raises if any batch failed since the last flush'''
+        if self._thread is not None:
+            # -- only what is queued now, saves from other threads meanwhile don't hold this up
+            with self._put_lock:
+                queued = self._queued
+            self._flushing.set()
+            try:
+                with self._written_changed:
+                    self._written_changed.wait_for(lambda: self._written >= queued)
+            finally:
+                self._flushing.clear()
+        with self._lock:
+            unreported = self.failed[self._reported:]
+            self._reported = len(self.failed)
+        if unreported:
+            raise Exception(f'{self.model.__name__} write-behind failed to write {sum([ len(rows) for e, rows in unreported ])} rows, kept in failed') from unreported[0][0]
+
+    def close(self):
+        '''Flushes and stops the writer, further saves raise'''
+        with self._put_lock:
+            if self._closed:
+                return
+            self._closed = True
+        atexit.unregister(self.close)
+        try:
+            self.flush()
+        finally:
+            if self._thread is not None:
+                self._thread.join()
@@ -1,11 +1,42 @@
-from datetime import datetime, timedelta, UTC
+from datetime import datetime, timedelta, tzinfo, UTC
+from zoneinfo import ZoneInfo
+from contextvars import ContextVar
+from contextlib import contextmanager
+import os
 import math
+import functools
 from pytz import timezone
 import cowpy 
 
 logger = cowpy.getLogger()
 
-HERE = timezone("America/New_York")
+# -- local timezone, in order: tz= on the call, local_timezone() context, FRANK_TIMEZONE env, America/New_York
+DEFAULT_TIMEZONE = os.getenv('FRANK_TIMEZONE', 'America/New_York')
+
+# -- kept for callers using the pytz object directly, frank.times itself uses zoneinfo
+# -- follows FRANK_TIMEZONE, but being a module constant it can't see local_timezone() or tz=, prefer utcify/localize_utc_date
+HERE = timezone(DEFAULT_TIMEZONE)
+
+_local_timezone = ContextVar('frank_local_timezone', default=None)
+
+@functools.lru_cache(maxsize=None)
+def _zone(tz):
+    '''tz name (or tzinfo) -> cached zoneinfo tzinfo'''
+    return tz if isinstance(tz, tzinfo) else ZoneInfo(tz)
+
+def _local_zone(tz=None):
+    if tz is not None:
+        return _zone(tz)
+    return _local_timezone.get() or _zone(DEFAULT_TIMEZONE)
+
+@contextmanager
+def local_timezone(tz):
+    '''Localizes to tz (name or tzinfo) for everything in this context, e.g. for the duration of one user's request'''
+    token = _local_timezone.set(_zone(tz))
+    try:
+        yield
+    finally:
+        _local_timezone.reset(token)
 
 SECOND = 1
 MINUTE = 60
@@ -36,16 +67,9 @@ time_units = [
     }
 ]
 
-def since_humanize(date_obj):
-
-    now = datetime.now(UTC)
-
-    if not date_obj.tzinfo or str(date_obj.tzinfo) != str(UTC.zone):
-        # print(date_obj.tzinfo)
-        date_obj = date_obj.astimezone(UTC)
+def _humanize_seconds(seconds_since):
 
     ret = ''
-    seconds_since = (now - date_obj).total_seconds()
     parts = 0
     MAX_PARTS = 1
 
@@ -63,6 +87,16 @@ def since_humanize(date_obj):
 
     return ret 
 
+def _seconds_since(date_obj, now):
+    # -- aware datetimes subtract across zones, only naive ones need converting (taken as system local time)
+    if date_obj.tzinfo is None:
+        date_obj = date_obj.astimezone(UTC)
+    return (now - date_obj).total_seconds()
+
+def since_humanize(date_obj, now=None):
+
+    return _humanize_seconds(_seconds_since(date_obj, now or datetime.now(UTC)))
+
 def ordinal(num):
     num = int(num)
     if num > 10 and num < 14:
@@ -76,32 +110,31 @@ def ordinal(num):
     else:
         return "th"
 
-def utc_date_boundaries(day_offset, tz):
+@functools.lru_cache(maxsize=4096)
+def _local_day_boundaries(day, tz):
+    '''(local date, tz) -> naive UTC start and end of that local day, and its naive local midnight'''
+    THERE = _zone(tz)
+    local_midnight = datetime(day.year, day.month, day.day)
+    # -- localize each midnight on its own so the offset is the one in effect that day, not today's
+    start_boundary = local_midnight.replace(tzinfo=THERE).astimezone(UTC).replace(tzinfo=None)
+    end_boundary = (local_midnight + timedelta(days=1)).replace(tzinfo=THERE).astimezone(UTC).replace(tzinfo=None)
+    return start_boundary, end_boundary, local_midnight
 
-    THERE = timezone(tz)
-
-    # 7/7 2 am (7/6 9 pm local)
-    utc_today = datetime.now(UTC)
-    loc_today = utc_today.astimezone(THERE) # THERE.localize(utc_today)
-    # loc_today = THERE.localize(utc_today)
-    hour_offset = loc_today.utcoffset().total_seconds() / (60*60)
-    # utc_today_str = datetime.strftime(utc_today, "%Y-%m-%d")
-    loc_today_str = datetime.strftime(loc_today, "%Y-%m-%d")
-    origin_applied_at_midnight = datetime.strptime(f'{loc_today_str}T00:00:00', "%Y-%m-%dT%H:%M:%S")
-    applied_at_midnight_utc = origin_applied_at_midnight + timedelta(days=int(day_offset))
-    
-    # applied_at_midnight_str = datetime.strftime(applied_at_midnight, "%Y-%m-%d")    
-    # logger.debug(f'getting points -- offset {day_offset} ({applied_at_midnight_str})')
-    
-    # -- with UTC values in the database, what we want to say is 
-    # -- where applied_at between <chosen date> +0500 and <chosen date + 1> +0500
-    # where_applied_at = datetime.strftime(applied_at_date, "%Y-%m-%d")
-    # where.update({'date(applied_at)': where_applied_at})
+def _local_today(tz):
+    return datetime.now(UTC).astimezone(_zone(tz)).date()
 
-    start_boundary = applied_at_midnight_utc - timedelta(hours=hour_offset)
-    end_boundary = applied_at_midnight_utc + timedelta(days=1) - timedelta(hours=hour_offset)
+def utc_date_boundaries(day_offset, tz):
+    '''
+        day_offset days from today in tz -> (UTC start of that local day, UTC end of that local day, local midnight), all naive
+        e.g. with UTC values in the database: where applied_at >= start and applied_at < end
+    '''
+    return _local_day_boundaries(_local_today(tz) + timedelta(days=int(day_offset)), tz)
 
-    return start_boundary, end_boundary, applied_at_midnight_utc
+def utc_date_boundaries_range(start_offset, end_offset, tz):
+    '''utc_date_boundaries for every day_offset in range(start_offset, end_offset), all relative to the same today'''
+    local_today = _local_today(tz)
+    for day_offset in range(int(start_offset), int(end_offset)):
+        yield _local_day_boundaries(local_today + timedelta(days=day_offset), tz)
 
 def date_humanize(date_obj):
     '''UTC Date() -> local Sun Jun 4th'''
@@ -112,11 +145,14 @@ def date_humanize(date_obj):
     # %d = 8
     # ordinal(%d) = th
     # Mon Apr 8th
-    return f'{datetime.strftime(date_obj, "%a %b")} {int(datetime.strftime(date_obj, "%d"))}{ordinal(datetime.strftime(date_obj, "%d"))}'
+    return f'{datetime.strftime(date_obj, "%a %b")} {date_obj.day}{ordinal(date_obj.day)}'
+
+def _time_fmt_local(local_date):
+    return f'{int(datetime.strftime(local_date, "%I"))}{datetime.strftime(local_date, ":%M %P")}'
 
-def time_fmt(date_obj):
+def time_fmt(date_obj, tz=None):
     '''UTC Date() -> local 12:24 pm'''
-    return f'{int(datetime.strftime(localize_utc_date(date_obj), "%I"))}{datetime.strftime(localize_utc_date(date_obj), ":%M %P")}'
+    return _time_fmt_local(localize_utc_date(date_obj, tz=tz))
 
 def parse_datestring_as_utc(date_str):
     return datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%S.000Z")
@@ -126,21 +162,109 @@ def truncate_date(date_obj, truncate_to):
         return datetime.strptime(datetime.strftime(date_obj, "%Y-%m-%d"), "%Y-%m-%d")    
     raise NotImplementedError(f'truncate_date not implemented for {truncate_to}')
 
-def utcify(naive_local_date_obj):
+def utcify(naive_local_date_obj, tz=None):
     '''local 2023-06-04T11:38:42.000Z -> UTC Date()'''
-    return HERE.localize(naive_local_date_obj).astimezone(UTC)        
+    local_date = naive_local_date_obj.replace(tzinfo=_local_zone(tz))
+    # -- as pytz localize(is_dst=False) did: wall times repeated or skipped by a DST change take the standard-time offset
+    if local_date.dst():
+        standard_date = local_date.replace(fold=1 - local_date.fold)
+        if not standard_date.dst():
+            local_date = standard_date
+    return local_date.astimezone(UTC)
 
-def localize_utc_date(utc_date):
+def localize_utc_date(utc_date, tz=None):
     '''
         UTC Date() -> local Date()
         if passed a naive date, no change is made - this effectively assumes an error has been made in passing an already-localized object
         the only problem case here is passing a value that is a UTC date but isn't aware it is UTC        
     '''
-    if not utc_date.tzinfo or str(utc_date.tzinfo) != str(UTC):
+    # -- any aware datetime converts straight to local, naive ones go through UTC first
+    if utc_date.tzinfo is None:
         utc_date = utc_date.astimezone(UTC)
-    return utc_date.astimezone(HERE)
+    return utc_date.astimezone(_local_zone(tz))
 
 # -- serializing datetime columns
-def date_loc_and_fmt(date_obj):
+def _loc_fmt_local(local_date):
+    return datetime.strftime(local_date, "%Y-%m-%d %I:%M %P")
+
+def date_loc_and_fmt(date_obj, tz=None):
     '''UTC Date() -> local 2023-06-04 09:24 am'''
-    return datetime.strftime(localize_utc_date(date_obj), "%Y-%m-%d %I:%M %P")
+    return _loc_fmt_local(localize_utc_date(date_obj, tz=tz))
+
+### -- batch versions for rendering many values (e.g. a report column)
+### -- each distinct minute is formatted once, local offsets are looked up once per quarter hour, and every value shares one 'now'
+### -- missing values (None, NaT) come back as None
+
+OFFSET_BUCKET = 15*MINUTE
+
+def _missing(date_obj):
+    # -- None, or NaT (pandas' NaT is not equal to itself)
+    return date_obj is None or date_obj != date_obj
+
+def _datetimes(dates):
+    '''Datetimes from a list or a NumPy datetime64 array (values taken as UTC)'''
+    if getattr(dates, 'dtype', None) is not None and dates.dtype.kind == 'M':
+        # -- NaT comes out of tolist() as None
+        return [ d.replace(tzinfo=UTC) if d is not None else None for d in dates.astype('datetime64[us]').tolist() ]
+    return dates
+
+def _format_many(dates, local_formatter, tz=None):
+    zone = _local_zone(tz)
+    formatted = {}
+    offsets = {}
+    results = []
+    for date_obj in _datetimes(dates):
+        if _missing(date_obj):
+            results.append(None)
+            continue
+        if not date_obj.tzinfo:
+            # -- naive values keep whatever localize_utc_date makes of them
+            results.append(local_formatter(localize_utc_date(date_obj, tz=zone)))
+            continue
+        minute = int(date_obj.timestamp() // MINUTE)
+        if minute not in formatted:
+            # -- zones only change offset on (at least) quarter-hour boundaries
+            bucket = minute * MINUTE // OFFSET_BUCKET
+            if bucket not in offsets:
+                offsets[bucket] = datetime.fromtimestamp(bucket * OFFSET_BUCKET, UTC).astimezone(zone).utcoffset()
+            formatted[minute] = local_formatter(datetime.fromtimestamp(minute * MINUTE, UTC).replace(tzinfo=None) + offsets[bucket])
+        results.append(formatted[minute])
+    return results
+
+def date_loc_and_fmt_many(dates, tz=None):
+    '''[UTC Date()] -> [local 2023-06-04 09:24 am]'''
+    return _format_many(dates, _loc_fmt_local, tz=tz)
+
+def time_fmt_many(dates, tz=None):
+    '''[UTC Date()] -> [local 12:24 pm]'''
+    return _format_many(dates, _time_fmt_local, tz=tz)
+
+def date_humanize_many(dates):
+    '''[Date()] -> [Sun Jun 4th]'''
+    humanized = {}
+    results = []
+    for date_obj in _datetimes(dates):
+        if _missing(date_obj):
+            results.append(None)
+            continue
+        day = (date_obj.year, date_obj.month, date_obj.day)
+        if day not in humanized:
+            humanized[day] = date_humanize(date_obj)
+        results.append(humanized[day])
+    return results
+
+def since_humanize_many(dates, now=None):
+    '''[Date()] -> [3 hours ago], all measured from the same now'''
+    now = now or datetime.now(UTC)
+    humanized = {}
+    results = []
+    for date_obj in _datetimes(dates):
+        if _missing(date_obj):
+            results.append(None)
+            continue
+        # -- same float delta as since_humanize, so both land in the same unit at the boundaries
+        seconds_since = _seconds_since(date_obj, now)
+        if seconds_since not in humanized:
+            humanized[seconds_since] = _humanize_seconds(seconds_since)
+        results.append(humanized[seconds_since])
+    return results
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+'''
+Columnizer timings on a 100k x 20 mixed table
+    python bench_columnizer.py [rows] [cols]
+'''
+
+import io
+import sys
+import time
+import random
+from datetime import datetime, timedelta
+from frank.columnizer import Columnizer
+
+def make_table(rows, cols):
+    rand = random.Random(0)
+    start = datetime(2024, 1, 1)
+    kinds = [
+        lambda: rand.randint(0, 10**rand.randint(1, 9)),
+        lambda: round(rand.uniform(-1000, 1000), rand.randint(0, 4)),
+        lambda: ''.join(rand.choices('abcdefghijklmnopqrstuvwxyz ', k=rand.randint(0, 30))),
+        lambda: start + timedelta(seconds=rand.randint(0, 10**8)),
+        lambda: None if rand.random() < 0.3 else rand.choice([True, False])
+    ]
+    header = [ f'col_{c}' for c in range(cols) ]
+    table = [ [ kinds[c % len(kinds)]() for c in range(cols) ] for _ in range(rows) ]
+    return table, header
+
+def timed(label, fn):
+    started = time.perf_counter()
+    fn()
+    print(f'{label:<32} {time.perf_counter() - started:.3f}s')
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    cols = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    table, header = make_table(rows, cols)
+    print(f'{rows} x {cols}')
+
+    strings = Columnizer()._stringify(table)
+    timed('_stringify', lambda: Columnizer()._stringify(table))
+    timed('_pad_tabs', lambda: Columnizer()._pad_tabs(strings))
+    timed('_pad_tabs width_sample=1000', lambda: Columnizer(width_sample=1000)._pad_tabs(strings))
+    timed('print()', lambda: Columnizer(output=io.StringIO()).print(table, header))
+    timed('print() colored', lambda: Columnizer(output=io.StringIO(), color=True).print(table, header))
+    timed('stream()', lambda: Columnizer(output=io.StringIO()).stream(iter(table), header))
+    timed('print() tsv', lambda: Columnizer(output=io.StringIO(), format='tsv').print(table, header))
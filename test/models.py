@@ -1,9 +1,24 @@
 from frank.database.model import BaseModel
-from frank.database.column import StringColumn, IntColumn, JsonColumn, BoolColumn, FloatColumn
+from frank.database.column import StringColumn, IntColumn, JsonColumn, BoolColumn, FloatColumn, TextColumn
 
 class TestieWidgets(BaseModel):
-    name = StringColumn(size=50)
+    name = StringColumn(size=50, index=True)
     counter = IntColumn()
     data = JsonColumn()
     maybe = BoolColumn()
-    value = FloatColumn()
\ No newline at end of file
+    value = FloatColumn()
+
+    class Meta:
+        indexes = [ ('name', 'counter'), 'data__status' ]
+
+class TestieTenantWidgets(BaseModel):
+    tenant = StringColumn(size=50)
+    name = StringColumn(size=50)
+
+    class Meta:
+        shard_key = 'tenant'
+
+class TestieNotes(BaseModel):
+    title = StringColumn(size=100, searchable=True)
+    body = TextColumn(searchable=True)
+    counter = IntColumn()
@@ -3,9 +3,35 @@
 import cowpy 
 
 
+import io
+import time
+import re
+import csv
+import gzip
+import os
+import sqlite3
+import contextlib
 import unittest
-from frank.database.init import setup 
-from models import TestieWidgets
+import unittest.mock
+import subprocess
+import tempfile
+import threading
+import pytz
+import simplejson as json
+from enum import Enum
+from datetime import datetime, timedelta, timezone, UTC
+from concurrent.futures import ThreadPoolExecutor
+from frank import times
+from frank.cache import FranKache, SqliteCacheBackend
+from frank.columnizer import Columnizer
+from frank.database.init import setup, _verify_database_schema, _schema_cache_key
+from frank.database.database import Database
+from frank.database.model import BaseModel
+from frank.database.column import StringColumn
+from frank.database.expression import F
+from frank.database.config import DatabaseConfig
+from frank.database.dialect import DbType, get_db_connection
+from models import TestieWidgets, TestieTenantWidgets, TestieNotes
 import random
 logger = cowpy.getLogger()
 
@@ -67,6 +93,713 @@ class TestModel(unittest.TestCase):
         all_widgets = TestieWidgets.all()
         upsert_test.upsert(on='name')
         self.assertNotIn(upsert_test.id, [ w.id for w in all_widgets ])        
+
+    def test_006_indexes(self):
+        index_names = Database.getInstance().get_index_names(TestieWidgets._meta.table)
+        self.assertIn('ix_testie_widgets_name', index_names)
+        self.assertIn('ix_testie_widgets_name_counter', index_names)
+
+    def test_007_replicas(self):
+        db = Database.getInstance()
+        if db.cfg.dbType != DbType.Sqlite:
+            self.skipTest('replicas are stood in for by sqlite files')
+        with tempfile.TemporaryDirectory() as replica_dir:
+            replica = DatabaseConfig(dbType='sqlite', filename=os.path.join(replica_dir, 'replica.db'))
+            # -- a directory can't be opened as a database
+            unreachable = DatabaseConfig(dbType='sqlite', filename=replica_dir)
+            conn = sqlite3.connect(replica.filename)
+            conn.execute(f'CREATE TABLE {TestieWidgets._meta.table} {db.create_table(TestieWidgets._meta)}')
+            conn.execute(f'insert into {TestieWidgets._meta.table} (name) values (?)', ('replica only',))
+            conn.commit()
+            conn.close()
+            db.replicas = [ unreachable, replica ]
+            read_your_writes = db.read_your_writes
+            try:
+                db.read_your_writes = 0
+                self.assertEqual(len(TestieWidgets.get(name='replica only')), 1)
+                self.assertEqual(len(TestieWidgets.get(name='replica only')), 1)
+                self.assertIn(0, db._replica_down)
+                with db.transaction():
+                    self.assertEqual(len(TestieWidgets.get(name='replica only')), 0)
+                # -- raw statements stay on the primary unless they say they are reads
+                db.raw(f'insert into {TestieWidgets._meta.table} (name) values (?)', ('raw write',))
+                self.assertEqual(len(db.raw(f'select id from {TestieWidgets._meta.table} where name = ?', ('raw write',))), 1)
+                self.assertEqual(len(db.raw(f'select id from {TestieWidgets._meta.table} where name = ?', ('replica only',), read=True)), 1)
+                db.raw(f'delete from {TestieWidgets._meta.table} where name = ?', ('raw write',))
+                db.read_your_writes = 60
+                # -- metadata reads don't count as writes
+                db._local.last_write = float('-inf')
+                db.get_index_names(TestieWidgets._meta.table)
+                db.get_table_definitions()
+                self.assertEqual(len(TestieWidgets.get(name='replica only')), 1)
+                TestieWidgets(name=TestModel.this_name).save()
+                self.assertEqual(len(TestieWidgets.get(name='replica only')), 0)
+            finally:
+                db.replicas = []
+                db._replica_down = {}
+                db.read_your_writes = read_your_writes
         
+
+    def test_008_shards(self):
+        db = Database.getInstance()
+        table = TestieTenantWidgets._meta.table
+        with tempfile.TemporaryDirectory() as shard_dir:
+            shards = { name: Database(config=DatabaseConfig(dbType='sqlite', filename=os.path.join(shard_dir, f'{name}.db')), standalone=True) for name in [ 'a', 'b' ] }
+            for shard in shards.values():
+                shard.init_table(TestieTenantWidgets._meta)
+            db.shards, db._scatter_pool = shards, ThreadPoolExecutor(max_workers=len(shards))
+            try:
+                tenants = [ f'tenant{i}' for i in range(8) ]
+                for tenant in tenants:
+                    TestieTenantWidgets(tenant=tenant, name='sharded').save()
+                for tenant in tenants:
+                    self.assertEqual(len(TestieTenantWidgets.get(tenant=tenant)), 1)
+                    self.assertEqual(len(db.shard_for(tenant).raw(f'select id from {table} where tenant = ?', (tenant,))), 1)
+                # -- no shard key, every shard answers
+                self.assertEqual(len(TestieTenantWidgets.get(name='sharded')), len(tenants))
+                self.assertTrue(all([ len(shard.raw(f'select id from {table}')) > 0 for shard in shards.values() ]))
+                TestieTenantWidgets.get(tenant='tenant0')[0].delete()
+                self.assertEqual(len(TestieTenantWidgets.get(name='sharded')), len(tenants) - 1)
+                with self.assertRaises(Exception):
+                    TestieTenantWidgets(name='no tenant').save()
+
+                # -- the same id is a different row on each shard
+                shard_ids = [ set([ r['id'] for r in shard.raw(f'select id from {table}') ]) for shard in shards.values() ]
+                shared_id = min(shard_ids[0] & shard_ids[1])
+                with self.assertRaises(Exception):
+                    TestieTenantWidgets.get(id=shared_id)
+                with self.assertRaises(Exception):
+                    TestieTenantWidgets.filter(id=shared_id).update(name='changed')
+                with self.assertRaises(Exception):
+                    TestieTenantWidgets.delete_by(id=shared_id)
+                for tenant in tenants[1:]:
+                    widget = TestieTenantWidgets.get(tenant=tenant)[0]
+                    self.assertEqual([ w.tenant for w in TestieTenantWidgets.get(id=widget.id, tenant=tenant) ], [ tenant ])
+                    self.assertEqual(TestieTenantWidgets.filter(id=widget.id, tenant=tenant).update(name='changed'), 1)
+                self.assertEqual(len(TestieTenantWidgets.get(name='changed')), len(tenants) - 1)
+            finally:
+                db.shards, db._scatter_pool = {}, None
+
+    def test_009_result_cache(self):
+        db = Database.getInstance()
+        name = f'{TestModel.this_name} cached'
+        TestieWidgets._meta.cache_ttl = 60
+        try:
+            hits = db.result_cache_stats()['hits']
+            self.assertEqual(TestieWidgets.get(name=name), [])
+            self.assertEqual(TestieWidgets.get(name=name), [])
+            self.assertEqual(db.result_cache_stats()['hits'], hits + 1)
+            # -- the insert bumps the table version, the cached empty result is not served again
+            TestieWidgets(name=name).save()
+            widgets = TestieWidgets.get(name=name)
+            self.assertEqual(len(widgets), 1)
+            widgets[0].delete()
+            self.assertEqual(TestieWidgets.get(name=name), [])
+        finally:
+            TestieWidgets._meta.cache_ttl = None
+
+    def test_010_dump(self):
+        db = Database.getInstance()
+        TestieWidgets(name=TestModel.this_name, counter=1).save()
+        TestieWidgets(name=TestModel.this_name, counter=2).save()
+        count = len(TestieWidgets.all())
+        with tempfile.TemporaryDirectory() as dump_dir:
+            ndjson = db.dump(dump_dir, compress=True, chunk_size=2)
+            path = os.path.join(dump_dir, f'{TestieWidgets._meta.table}.ndjson.gz')
+            self.assertEqual(ndjson[path], count)
+            with gzip.open(path, 'rt') as f:
+                records = [ json.loads(line) for line in f ]
+            self.assertEqual(len(records), count)
+            self.assertEqual(len(set([ r['id'] for r in records ])), count)
+            dumped = db.dump(dump_dir, format='csv', parallel=2, models=[ TestieWidgets ])
+            path = os.path.join(dump_dir, f'{TestieWidgets._meta.table}.csv')
+            self.assertEqual(list(dumped.keys()), [ path ])
+            with open(path, newline='') as f:
+                rows = list(csv.reader(f))
+            self.assertEqual(rows[0], list(TestieWidgets._meta.select_col_names))
+            self.assertEqual(len(rows), count + 1)
+
+    def test_011_load_file(self):
+        db = Database.getInstance()
+        name = f'{TestModel.this_name} loaded'
+        try:
+            with tempfile.TemporaryDirectory() as load_dir:
+                path = os.path.join(load_dir, 'widgets.csv')
+                with open(path, 'w', newline='') as f:
+                    writer = csv.writer(f)
+                    writer.writerow([ 'name', 'counter', 'maybe', 'value', 'data' ])
+                    writer.writerows([ [ name, i, 'true' if i % 2 else 'false', f'{i}.5', '' ] for i in range(25) ])
+                self.assertEqual(TestieWidgets.load_file(path, batch_size=10), 25)
+                widgets = TestieWidgets.get(name=name)
+                self.assertEqual(sorted([ w.counter for w in widgets ]), list(range(25)))
+                self.assertEqual(sorted([ w.value for w in widgets ])[0], 0.5)
+                self.assertIsNotNone(widgets[0].created_at)
+                # -- a dump loads back with its ids, the rows already there collide
+                count = len(TestieWidgets.all())
+                db.dump(load_dir, compress=True, models=[ TestieWidgets ])
+                path = os.path.join(load_dir, f'{TestieWidgets._meta.table}.ndjson.gz')
+                with self.assertRaises(Exception):
+                    TestieWidgets.load_file(path)
+                self.assertEqual(TestieWidgets.load_file(path, on_conflict='ignore'), count)
+                self.assertEqual(len(TestieWidgets.all()), count)
+        finally:
+            for w in TestieWidgets.get(name=name):
+                w.delete()
+
+    def test_012_write_behind(self):
+        name = f'{TestModel.this_name} behind'
+        writer = TestieWidgets.write_behind(batch_rows=50, interval_ms=20, max_rows=100)
+        try:
+            for i in range(120):
+                TestieWidgets(name=name, counter=i).save()
+            writer.flush()
+            widgets = TestieWidgets.get(name=name)
+            self.assertEqual(sorted([ w.counter for w in widgets ]), list(range(120)))
+            # -- a row with an id replaces the stored one
+            widgets[0].counter = 1000
+            widgets[0].save()
+            writer.flush()
+            self.assertEqual(TestieWidgets.get(id=widgets[0].id)[0].counter, 1000)
+        finally:
+            TestieWidgets.write_behind(False)
+            for w in TestieWidgets.get(name=name):
+                w.delete()
+        with self.assertRaises(Exception):
+            writer.put(TestieWidgets(name=name))
+
+        class TestieMissingWidgets(BaseModel):
+            name = StringColumn(size=50)
+        failed = []
+        writer = TestieMissingWidgets.write_behind(on_error=lambda e, rows: failed.extend(rows))
+        TestieMissingWidgets(name=name).save()
+        writer.close()
+        self.assertEqual([ r['name'] for r in failed ], [ name ])
+        # -- without on_error the rows are kept and the next flush raises, once
+        writer = TestieMissingWidgets.write_behind()
+        TestieMissingWidgets(name=name).save()
+        with self.assertRaises(Exception):
+            writer.flush()
+        writer.flush()
+        self.assertEqual([ r['name'] for e, rows in writer.failed for r in rows ], [ name ])
+        TestieMissingWidgets.write_behind(False)
+
+    def test_013_column_expressions(self):
+        name = f'{TestModel.this_name} expressions'
+        widget = TestieWidgets(name=name, counter=1)
+        widget.save()
+        other = TestieWidgets(name=name)
+        other.save()
+        try:
+            widget.increment('counter', 2)
+            self.assertEqual(widget.counter, 3)
+            # -- null counts as zero
+            other.increment('counter')
+            self.assertEqual(TestieWidgets.get(id=other.id)[0].counter, 1)
+
+            # -- no increment is lost to another worker's read-modify-write
+            def bump(_):
+                w = TestieWidgets.get(id=widget.id)[0]
+                for i in range(25):
+                    w.increment('counter')
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                list(pool.map(bump, range(8)))
+            self.assertEqual(TestieWidgets.get(id=widget.id)[0].counter, 203)
+
+            self.assertEqual(TestieWidgets.filter(name=name, counter__gt=100).update(counter=F('counter') * 2 - 6), 1)
+            self.assertEqual(TestieWidgets.filter(id=other.id).update(name=F('name') + ' appended'), 1)
+            self.assertEqual(TestieWidgets.get(id=widget.id)[0].counter, 400)
+            self.assertEqual(TestieWidgets.get(id=other.id)[0].name, f'{name} appended')
+            self.assertEqual(TestieWidgets.filter(name=name, counter=0).update(counter=5), 0)
+
+            # -- filters mean the same to update() as to get()
+            TestieWidgets.filter(id=other.id).update(maybe=True, data=json.dumps({'flag': True}))
+            for where in [ {'maybe': True}, {'data__flag': True}, {'value': None} ]:
+                self.assertEqual([ w.id for w in TestieWidgets.get(id=other.id, **where) ], [ other.id ])
+                self.assertEqual(TestieWidgets.filter(id=other.id, **where).update(counter=7), 1)
+
+            # -- no filter is every row
+            everything = len(TestieWidgets.all())
+            self.assertEqual(TestieWidgets.filter().update(counter=F('counter')), everything)
+            with self.assertRaises(Exception):
+                TestieWidgets.filter(id=widget.id).update(nope=1)
+        finally:
+            widget.delete()
+            other.delete()
+
+    def test_014_json_paths(self):
+        name = f'{TestModel.this_name} json'
+        widgets = [ TestieWidgets(name=name, data=json.dumps(d)) for d in [
+            {'status': 'ok', 'count': 7, 'meta': {'tags': ['a', 'b']}},
+            {'status': 'ok', 'count': 3, 'flag': True},
+            {'status': 'failed', 'count': 12}
+        ] ]
+        for w in widgets:
+            w.save()
+        try:
+            def counts(**kwargs):
+                return sorted([ json.loads(w.data)['count'] for w in TestieWidgets.get(name=name, **kwargs) ])
+            self.assertEqual(counts(data__status='ok'), [3, 7])
+            self.assertEqual(counts(data__count__gt=5), [7, 12])
+            self.assertEqual(counts(data__status='ok', data__count__lte=3), [3])
+            self.assertEqual(counts(data__meta__tags__1='b'), [7])
+            self.assertEqual(counts(data__flag=True), [3])
+            self.assertEqual(TestieWidgets.filter(name=name, data__status='failed').update(counter=1), 1)
+            with self.assertRaises(Exception):
+                TestieWidgets.get(**{'data__status\') or (\'1': 1})
+
+            # -- the indexed path is served from the index
+            db = Database.getInstance()
+            explain = 'explain query plan' if db.cfg.dbType == DbType.Sqlite else 'explain'
+            plan = db.raw(f"{explain} select id from testie_widgets where {db._json_value(TestieWidgets._meta, 'data__status')} = 'ok'")
+            self.assertIn('ix_testie_widgets_data__status', str(plan))
+        finally:
+            for w in widgets:
+                w.delete()
+
+    def test_015_search(self):
+        notes = [ TestieNotes(title=t, body=b) for t, b in [
+            ('Quarterly report', 'revenue grew while costs held flat'),
+            ('Offsite', 'bring the quarterly numbers and a revenue chart, revenue first'),
+            ('Groceries', 'eggs, flour, butter')
+        ] ]
+        for n in notes:
+            n.save()
+        try:
+            self.assertEqual([ n.title for n in TestieNotes.search('revenue') ], ['Offsite', 'Quarterly report'])
+            self.assertEqual([ n.title for n in TestieNotes.search('quarterly revenue', limit=1) ], ['Offsite'])
+            self.assertEqual(TestieNotes.search('"flour" -or: (butter')[0].title, 'Groceries')
+            self.assertEqual(TestieNotes.search('...'), [])
+
+            # -- updates, replaced rows and deletes are kept in step
+            notes[2].body = 'milk'
+            notes[2].save()
+            self.assertEqual(TestieNotes.search('flour'), [])
+            self.assertEqual([ n.title for n in TestieNotes.search('milk') ], ['Groceries'])
+            TestieNotes.filter(id=notes[2].id).update(counter=1)
+            self.assertEqual([ n.counter for n in TestieNotes.search('milk') ], [1])
+            Database.getInstance()._insert_many('testie_notes', ('id', 'title', 'body'), [ (notes[2].id, 'Groceries', 'bread') ], on_conflict='replace')
+            self.assertEqual(TestieNotes.search('milk'), [])
+            self.assertEqual(len(TestieNotes.search('bread')), 1)
+            notes[0].delete()
+            self.assertEqual([ n.title for n in TestieNotes.search('revenue') ], ['Offsite'])
+            with self.assertRaises(Exception):
+                TestieWidgets.search('anything')
+        finally:
+            for n in TestieNotes.all():
+                n.delete()
+
+    def test_016_schema_cache_drift(self):
+        db = Database(config=DatabaseConfig(dbType='sqlite', filename=':memory:'), standalone=True)
+        db.raw(f"create table testie_widgets {db.create_table(TestieWidgets._meta).replace('value float', 'value integer')}")
+        schema_cache = {}
+        _verify_database_schema(db, [ TestieWidgets, TestieTenantWidgets ], schema_cache, True)
+        # -- the drifted table is left out of the cache so the next start checks it again
+        self.assertEqual(list(schema_cache[_schema_cache_key(db.cfg)]), [ TestieTenantWidgets._meta.table ])
+
+    def test_017_infile_values(self):
+        db = Database.getInstance()
+        created_at = datetime(2024, 7, 4, 16, 30, 5, 250000)
+        self.assertEqual(db._infile_value(created_at), '2024-07-04 16:30:05')
+        self.assertEqual(db._infile_value(created_at.replace(tzinfo=UTC)), '2024-07-04 16:30:05')
+        self.assertEqual(db._infile_value(created_at.replace(tzinfo=timezone(timedelta(hours=-4)))), '2024-07-04 20:30:05')
+        self.assertEqual([ db._infile_value(v) for v in [ None, True, 7, 'a\tb\nc\\' ] ], [ '\\N', '1', '7', 'a\\tb\\nc\\\\' ])
+
+    def test_018_cursor_errors_raise(self):
+        db = Database.getInstance()
+
+        class ContextCursorConnection:
+            # -- a connection whose cursors are context managers, as mariadb's are
+            def __init__(self):
+                self.conn = sqlite3.connect(':memory:')
+            def cursor(self):
+                return contextlib.closing(self.conn.cursor())
+            def commit(self):
+                self.conn.commit()
+            def close(self):
+                self.conn.close()
+
+        with self.assertRaises(sqlite3.OperationalError):
+            with db.get_cursor(ContextCursorConnection(), config=db.cfg) as c:
+                c.execute('select id from no_such_table')
+
+    def test_019_write_behind_flush(self):
+        name = f'{TestModel.this_name} behind flush'
+        writer = TestieWidgets.write_behind(interval_ms=20)
+        stop = threading.Event()
+        def keep_saving():
+            while not stop.is_set():
+                TestieWidgets(name=name).save()
+        saver = threading.Thread(target=keep_saving)
+        try:
+            TestieWidgets(name=name, counter=1).save()
+            saver.start()
+            # -- returns once the rows queued so far are written, while the other thread keeps saving
+            writer.flush()
+            self.assertEqual(len(TestieWidgets.get(name=name, counter=1)), 1)
+        finally:
+            stop.set()
+            saver.join()
+            TestieWidgets.write_behind(False)
+            for w in TestieWidgets.get(name=name):
+                w.delete()
+
+    def test_020_json_path_ddl(self):
+        mariadb = Database(config=DatabaseConfig(dbType='mariadb'), standalone=True)
+        sqlite = Database(config=DatabaseConfig(dbType='sqlite', filename=':memory:'), standalone=True)
+        generated = "data__status varchar(255) GENERATED ALWAYS AS (json_value(data,'$.status')) VIRTUAL"
+        # -- the generated column is part of the table as declared, so it isn't drift
+        self.assertTrue(mariadb.create_table(TestieWidgets._meta).endswith(f', {generated})'))
+        self.assertEqual(mariadb._json_generated_column(TestieWidgets._meta, 'data__status'), f'ALTER TABLE testie_widgets ADD COLUMN IF NOT EXISTS {generated}')
+        self.assertEqual(mariadb.create_index(TestieWidgets._meta, TestieWidgets._meta.indexes[-1]), 'CREATE INDEX ix_testie_widgets_data__status ON testie_widgets (data__status)')
+        self.assertNotIn('GENERATED', sqlite.create_table(TestieWidgets._meta))
+        self.assertEqual(sqlite.create_index(TestieWidgets._meta, TestieWidgets._meta.indexes[-1]), "CREATE INDEX ix_testie_widgets_data__status ON testie_widgets (json_extract(data, '$.status'))")
+
+    def test_021_write_behind_close_race(self):
+        name = f'{TestModel.this_name} behind close'
+        writer = TestieWidgets.write_behind(interval_ms=5)
+        saved = []
+        def keep_saving():
+            while True:
+                try:
+                    TestieWidgets(name=name).save()
+                except Exception:
+                    return
+                saved.append(1)
+        savers = [ threading.Thread(target=keep_saving) for _ in range(4) ]
+        try:
+            for saver in savers:
+                saver.start()
+            while len(saved) < 200:
+                time.sleep(0.001)
+            writer.close()
+            for saver in savers:
+                saver.join()
+            # -- every save that didn't raise was written before close() returned
+            self.assertEqual(len(TestieWidgets.get(name=name)), len(saved))
+        finally:
+            TestieWidgets.write_behind(False)
+            for w in TestieWidgets.get(name=name):
+                w.delete()
+
+class TestSqliteConnection(unittest.TestCase):
+
+    def test_001_memory_shared_across_threads(self):
+        config = DatabaseConfig(dbType='sqlite', filename=':memory:')
+        conn = get_db_connection(config)
+        self.assertIs(get_db_connection(config), conn)
+        conn.execute('create table if not exists shared_widgets (v integer)')
+        conn.execute('insert into shared_widgets (v) values (1)')
+        conn.commit()
+        counts = []
+        thread = threading.Thread(target=lambda: counts.append(get_db_connection(config).execute('select count(*) from shared_widgets').fetchone()[0]))
+        thread.start()
+        thread.join()
+        self.assertEqual(counts, [1])
+        # -- another :memory: config is a database of its own
+        other = get_db_connection(DatabaseConfig(dbType='sqlite', filename=':memory:'))
+        self.assertIsNot(other, conn)
+        self.assertEqual(other.execute("select count(*) from sqlite_master where name = 'shared_widgets'").fetchone()[0], 0)
+
+    def test_002_pragmas(self):
+        with tempfile.TemporaryDirectory() as db_dir:
+            config = DatabaseConfig(dbType='sqlite', filename=f'file:{os.path.join(db_dir, "tuned.db")}?mode=rwc', synchronous='full')
+            conn = get_db_connection(config)
+            self.assertEqual(conn.execute('pragma journal_mode').fetchone()[0], 'wal')
+            self.assertEqual(conn.execute('pragma synchronous').fetchone()[0], 2)
+            self.assertEqual(conn.execute('pragma temp_store').fetchone()[0], 2)
+            self.assertEqual(conn.execute('pragma busy_timeout').fetchone()[0], 5000)
+
+class TestCacheType(Enum):
+    RemoteStats = 0
+    Archives = 1
+
+class TestFranKache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.cache = FranKache(types=TestCacheType, cache_file=os.path.join(self.cache_dir.name, 'cache.json'))
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def test_001_store_fetch(self):
+        self.assertIsNone(self.cache._cache_fetch('missing'))
+        self.cache._cache_store('listing', {'files': ['a', 'b']})
+        self.assertEqual(self.cache._cache_fetch('listing'), {'files': ['a', 'b']})
+        self.assertIsInstance(self.cache.backend, SqliteCacheBackend)
+
+    def test_002_shared_file(self):
+        self.cache._cache_store('listing', [1, 2, 3])
+        other = FranKache(types=TestCacheType, cache_file=self.cache.cache_file)
+        self.assertEqual(other._cache_fetch('listing'), [1, 2, 3])
+        other._backend().delete('listing')
+        self.assertIsNone(FranKache(types=TestCacheType, cache_file=self.cache.cache_file)._cache_fetch('listing'))
+
+    def test_003_memory_tier(self):
+        cache = FranKache(types=TestCacheType, cache_file=self.cache.cache_file, max_entries=2, ttls={TestCacheType.RemoteStats: 0})
+        cache._cache_store('a', 1)
+        cache._cache_store('b', 2)
+        cache._cache_store('c', 3)
+        cache._cache_store('stats', 4, cache_type=TestCacheType.RemoteStats)
+        self.assertEqual(cache._cache_fetch('c'), 3)
+        self.assertEqual(cache._cache_fetch('a'), 1)
+        self.assertIsNone(cache._cache_fetch('stats'))
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['evictions'], 3)
+        self.assertLessEqual(stats['entries'], 2)
+
+    def test_004_memoize(self):
+        calls = []
+
+        @self.cache.memoize(ttl=60)
+        def listing(target, deep=False):
+            calls.append(target)
+            return [ f'{target}-{i}' for i in range(20) ]
+
+        self.assertEqual(listing('a'), listing('a'))
+        listing('a', deep=True)
+        self.assertEqual(calls, ['a', 'a'])
+        listing.invalidate('a')
+        listing('a')
+        self.assertEqual(len(calls), 3)
+
+        # -- compression is left to the backend codec, the record holds the value itself
+        backend = self.cache._backend()
+        backend.compress_over = 16
+        listing.invalidate('b')
+        listing('b')
+        cid = [ k for k in backend.keys() if k.startswith('memoize_') and backend.get(k)['content'][0] == 'b-0' ][0]
+        entry = backend._conn().execute('select value from frankache where key = ?', (cid,)).fetchone()[0]
+        self.assertEqual(entry[1:2], b'z')
+        self.assertEqual(backend.get(cid)['content'], listing('b'))
+
+    def test_005_codecs_and_migration(self):
+        with open(self.cache.cache_file, 'w') as f:
+            f.write(json.dumps({ 'listing': { 'time': datetime.strftime(datetime.utcnow(), '%c'), 'content': ['a', 'b'] } }, indent=4))
+        migrated = FranKache(types=TestCacheType, cache_file=self.cache.cache_file, codec='pickle', compress_over=16)
+        self.assertEqual(migrated._cache_fetch('listing'), ['a', 'b'])
+        self.assertFalse(os.path.exists(self.cache.cache_file))
+        migrated._cache_store('big', { 'files': list(range(100)) })
+        self.assertEqual(FranKache(types=TestCacheType, cache_file=self.cache.cache_file)._cache_fetch('big'), { 'files': list(range(100)) })
+
+    def test_006_memoize_values(self):
+        calls = []
+
+        @self.cache.memoize(ttl=60)
+        def pair(n):
+            calls.append(n)
+            return (n, [ n ])
+
+        first = pair(1)
+        first[1].append('changed')
+        # -- json has no tuples, the first call and memory and backend hits all give a list
+        self.assertEqual(first, [ 1, [ 1, 'changed' ] ])
+        self.assertEqual(pair(1), [ 1, [ 1 ] ])
+        self.assertEqual(FranKache(cache_file=self.cache.cache_file).memoize(ttl=60)(pair.__wrapped__)(1), [ 1, [ 1 ] ])
+        self.assertEqual(calls, [ 1 ])
+
+        pickled = FranKache(cache_file=os.path.join(self.cache_dir.name, 'pickled.json'), codec='pickle')
+        pickled_pair = pickled.memoize(ttl=60)(pair.__wrapped__)
+        self.assertEqual([ pickled_pair(2), pickled_pair(2) ], [ (2, [ 2 ]), (2, [ 2 ]) ])
+        self.assertEqual(FranKache(cache_file=pickled.cache_file, codec='pickle').memoize(ttl=60)(pair.__wrapped__)(2), (2, [ 2 ]))
+
+        @self.cache.memoize(ttl=60)
+        def stamp():
+            calls.append('stamp')
+            return datetime(2024, 1, 1)
+
+        # -- json can't hold a datetime, the call still succeeds, it just isn't cached
+        self.assertEqual([ stamp(), stamp() ], [ datetime(2024, 1, 1) ] * 2)
+        self.assertEqual(calls.count('stamp'), 2)
+
+    def test_007_default_cache_file(self):
+        xdg_cache_home = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = self.cache_dir.name
+        try:
+            cache = FranKache(bucket_name='widgets')
+            cache.memoize()(lambda: 1)()
+            self.assertEqual(cache.backend.filename, os.path.join(self.cache_dir.name, 'frank', 'widgets.db'))
+            self.assertTrue(os.path.exists(cache.backend.filename))
+            self.assertEqual(FranKache()._backend().filename, os.path.join(self.cache_dir.name, 'frank', 'frankache.db'))
+        finally:
+            if xdg_cache_home is None:
+                del os.environ['XDG_CACHE_HOME']
+            else:
+                os.environ['XDG_CACHE_HOME'] = xdg_cache_home
+
+    def test_008_memory_bytes_with_codec(self):
+        # -- sized as the codec encodes it, json would fail on the datetime
+        cache = FranKache(types=TestCacheType, cache_file=self.cache.cache_file, codec='pickle', max_bytes=1 << 20)
+        stamp = datetime(2024, 7, 4, 16, 30, tzinfo=UTC)
+        cache._cache_store('stamp', { 'at': stamp })
+        self.assertGreater(cache.stats()['bytes'], 0)
+        self.assertEqual(cache._cache_fetch('stamp'), { 'at': stamp })
+        other = FranKache(types=TestCacheType, cache_file=self.cache.cache_file, codec='pickle', max_bytes=1 << 20)
+        self.assertEqual(other._cache_fetch('stamp'), { 'at': stamp })
+        self.assertGreater(other.stats()['bytes'], 0)
+
+    def test_009_cache_ids(self):
+        self.cache.bucket_name = 'widgets'
+        self.assertEqual(self.cache._get_cache_id(TestCacheType.RemoteStats, 'a'), 'remote-stats_bucket-$widgets_target-a')
+        self.assertEqual(self.cache._get_cache_id(TestCacheType.Archives), 'archives_bucket-$widgets')
+        # -- no type never lands on the stats records, with or without types
+        self.cache._cache_store(self.cache._get_cache_id(TestCacheType.RemoteStats), 'stats')
+        for cache in [ self.cache, FranKache(bucket_name='widgets', cache_file=self.cache.cache_file) ]:
+            self.assertEqual(cache._get_cache_id(None), 'bucket-$widgets')
+            self.assertIsNone(cache._cache_fetch(cache._get_cache_id(None)))
+
+class TestTimes(unittest.TestCase):
+
+    def test_001_many_matches_scalar(self):
+        # -- spans the 2024-11-03 DST change
+        dates = [ datetime(2024, 11, 3, 4, tzinfo=UTC) + timedelta(minutes=7*i, seconds=i) for i in range(60) ]
+        self.assertEqual(times.date_loc_and_fmt_many(dates), [ times.date_loc_and_fmt(d) for d in dates ])
+        self.assertEqual(times.time_fmt_many(dates), [ times.time_fmt(d) for d in dates ])
+        self.assertEqual(times.date_humanize_many(dates), [ times.date_humanize(d) for d in dates ])
+        now = dates[0]
+        self.assertEqual(times.since_humanize_many([ now - timedelta(hours=3), now - timedelta(days=2), now ], now=now), [ '3 hours  ago', '2 days  ago', 'just now' ])
+
+    def test_002_date_boundaries_range(self):
+        boundaries = list(times.utc_date_boundaries_range(-365, 0, 'America/New_York'))
+        self.assertEqual(len(boundaries), 365)
+        self.assertEqual(boundaries[-1], times.utc_date_boundaries(-1, 'America/New_York'))
+        for (_, end, _), (start, _, _) in zip(boundaries, boundaries[1:]):
+            self.assertEqual(end, start)
+        # -- a year of New York days has exactly one spring-forward and one fall-back day
+        day_hours = sorted([ (end - start).total_seconds() / 3600 for start, end, _ in boundaries ])
+        self.assertEqual(day_hours[0], 23)
+        self.assertEqual(day_hours[-1], 25)
+        self.assertEqual(day_hours[1:-1], [24] * 363)
+
+    def test_003_local_timezone(self):
+        utc_date = datetime(2024, 7, 4, 16, 30, tzinfo=UTC)
+        self.assertEqual(times.date_loc_and_fmt(utc_date), '2024-07-04 12:30 pm')
+        self.assertEqual(times.date_loc_and_fmt(utc_date, tz='Asia/Tokyo'), '2024-07-05 01:30 am')
+        with times.local_timezone('Europe/London'):
+            self.assertEqual(times.time_fmt(utc_date), '5:30 pm')
+            self.assertEqual(times.date_loc_and_fmt_many([utc_date]), ['2024-07-04 05:30 pm'])
+            self.assertEqual(times.utcify(datetime(2024, 7, 4, 17, 30)), utc_date)
+        self.assertEqual(times.localize_utc_date(times.localize_utc_date(utc_date, tz='Asia/Tokyo')), times.localize_utc_date(utc_date))
+
+    def test_004_since_humanize_many_boundaries(self):
+        now = datetime(2024, 11, 3, 4, tzinfo=UTC)
+        seconds = [ 0, 0.5, 1, 1.5, 59.5, 60, 60.5, 119.5, 120.5, times.HOUR - 0.5, times.HOUR, times.HOUR + 0.5, times.DAY + 0.5, times.WEEK - 0.5, times.WEEK + 0.5 ]
+        dates = [ now - timedelta(seconds=s) for s in seconds ]
+        self.assertEqual(times.since_humanize_many(dates, now=now), [ times.since_humanize(d, now=now) for d in dates ])
+        self.assertEqual(times.since_humanize_many([now - timedelta(seconds=60.5)], now=now), ['1 minute  ago'])
+        # -- missing values pass through
+        self.assertEqual(times.since_humanize_many([ None, now ], now=now), [ None, 'just now' ])
+        try:
+            import numpy
+        except ImportError:
+            return
+        stamps = numpy.array([ '2024-11-03T02:59:00', 'NaT' ], dtype='datetime64[s]')
+        self.assertEqual(times.since_humanize_many(stamps, now=now), [ '1 hour  ago', None ])
+
+    def test_005_utcify_dst(self):
+        HERE = pytz.timezone('America/New_York')
+        # -- an ordinary time, the repeated hour of fall-back and the skipped hour of spring-forward
+        for local_date in [ datetime(2024, 7, 4, 12, 30), datetime(2024, 11, 3, 1, 30), datetime(2024, 3, 10, 2, 30), datetime(2024, 1, 5, 9) ]:
+            self.assertEqual(times.utcify(local_date, tz='America/New_York'), HERE.localize(local_date).astimezone(UTC))
+        self.assertEqual(times.utcify(datetime(2024, 11, 3, 1, 30), tz='America/New_York'), datetime(2024, 11, 3, 6, 30, tzinfo=UTC))
+        self.assertEqual(times.utcify(datetime(2024, 3, 10, 2, 30), tz='America/New_York'), datetime(2024, 3, 10, 7, 30, tzinfo=UTC))
+
+    def test_006_many_missing_values(self):
+        date_obj = datetime(2024, 11, 3, 2, 59, tzinfo=UTC)
+        expected = [ [ times.date_loc_and_fmt(date_obj), None ], [ times.time_fmt(date_obj), None ], [ times.date_humanize(date_obj), None ] ]
+        formatters = [ times.date_loc_and_fmt_many, times.time_fmt_many, times.date_humanize_many ]
+        self.assertEqual([ f([ date_obj, None ]) for f in formatters ], expected)
+        try:
+            import numpy
+        except ImportError:
+            return
+        stamps = numpy.array([ '2024-11-03T02:59', 'NaT' ], dtype='datetime64[s]')
+        self.assertEqual([ f(stamps) for f in formatters ], expected)
+
+class TestColumnizer(unittest.TestCase):
+
+    def test_001_widths(self):
+        c = Columnizer(output=io.StringIO())
+        c.print([ [ 'a', 1234, None ], [ 'abcdef', 1, 'x' ] ], [ 'name', 'n', 'note' ])
+        self.assertEqual(c.tabs, [ 1, 10, 17, 24 ])
+        lines = c.output.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertIn('abcdef      1', lines[2])
+        # -- a width sample takes the same rows every time, here the 1st, 4th and 7th
+        rows = [ [ 'x' * (i + 1) ] for i in range(8) ]
+        c = Columnizer(width_sample=3)
+        c._pad_tabs(c._stringify(rows))
+        self.assertEqual(c.tabs, [ 1, 11 ])
+
+    def test_002_stream(self):
+        rows = ( [ f'row{i}', i ] for i in range(2500) )
+        c = Columnizer(output=io.StringIO(), write_chunk_rows=100)
+        c.stream(rows, [ 'name', 'n' ], width_sample=10)
+        lines = c.output.getvalue().splitlines()
+        self.assertEqual(len(lines), 2501)
+        self.assertEqual(c.tabs, [ 1, 8, 12 ])
+        c = Columnizer(output=io.StringIO())
+        c.stream(iter([ [ 'a', 1 ] ]), [ 'name', 'n' ], widths=[ 10, 5 ])
+        self.assertEqual(c.tabs, [ 1, 14, 22 ])
+
+    def test_003_formats(self):
+        rows = [ [ 'a', 1, None ], [ 'b,c', 2.5, 'x' ] ]
+        header = [ 'name', 'n', 'note' ]
+        expected = {
+            'tsv': 'name\tn\tnote\na\t1\t\nb,c\t2.5\tx\n',
+            'csv': 'name,n,note\na,1,\n"b,c",2.5,x\n',
+            'jsonl': '{"name": "a", "n": 1, "note": null}\n{"name": "b,c", "n": 2.5, "note": "x"}\n'
+        }
+        for format, text in expected.items():
+            c = Columnizer(output=io.StringIO(), format=format)
+            c.print(rows, header)
+            self.assertEqual(c.output.getvalue(), text)
+            c = Columnizer(output=io.StringIO(), format=format)
+            c.stream(iter(rows), header)
+            self.assertEqual(c.output.getvalue(), text)
+        # -- no terminal, no color escapes
+        c = Columnizer(output=io.StringIO())
+        c.print(rows, header)
+        self.assertNotIn('\033', c.output.getvalue())
+
+    def test_004_alignment(self):
+        c = Columnizer()
+        self.assertEqual(c._infer_alignment([ [ 'a', 1, '2.5', None, True ], [ 'b', None, '-3', 'x', False ] ]), [ 'l', 'r', 'r', 'l', 'l' ])
+        c = Columnizer(output=io.StringIO())
+        c.print([ [ 'a', 1 ], [ 'b', 1234 ] ], [ 'name', 'count' ])
+        self.assertEqual(c.output.getvalue().splitlines()[1], 'a          1')
+
+    def test_005_delimited_round_trip(self):
+        rows = [ [ 'tab\there', 'line\nbreak', 'back\\slash', None ], [ 'quote "q"', '', 1, 'x' ] ]
+        for format in [ 'tsv', 'csv' ]:
+            c = Columnizer(output=io.StringIO(), format=format)
+            c.print(rows, [ 'a', 'b', 'c', 'd' ])
+            read = list(csv.reader(io.StringIO(c.output.getvalue()), delimiter='\t' if format == 'tsv' else ','))
+            self.assertEqual(read, [ [ 'a', 'b', 'c', 'd' ], [ 'tab\there', 'line\nbreak', 'back\\slash', '' ], [ 'quote "q"', '', '1', 'x' ] ])
+
+    def test_006_matches_shell(self):
+        rows = [ [ 'alpha', 1, 2.5, None ], [ 'b', 12345, -3.25, 'a note' ], [ 'gamma delta', 7, 0.0, True ] ]
+        header = [ 'name', 'count', 'value', 'note' ]
+        c = Columnizer(output=io.StringIO())
+        c.print(rows, header)
+
+        # -- run the shell path's printf commands without tabs, and expand the tabs at its stops as the terminal would
+        shell = Columnizer(shell=True)
+        commands = []
+        with unittest.mock.patch('frank.columnizer.subprocess.run', lambda command, shell: commands.append(command)):
+            shell.print(rows, header)
+        printed = "".join([ subprocess.run(re.sub(r'tabs [^;]*;', '', command), shell=True, capture_output=True, text=True).stdout for command in commands ])
+        lines = []
+        for line in re.sub(r'\033\[[0-9;]*m', '', printed).splitlines():
+            expanded = ''
+            for cell in line.split('\t'):
+                if expanded:
+                    expanded = expanded.ljust(next(( t - 1 for t in shell.tabs if t - 1 > len(expanded) )))
+                expanded += cell
+            lines.append(expanded)
+        self.assertEqual(shell.tabs, c.tabs)
+        self.assertEqual(c.output.getvalue().splitlines(), lines)
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file